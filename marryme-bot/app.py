@@ -1,15 +1,27 @@
-from flask import Flask, request, abort
+from flask import Flask, request, abort, Response, jsonify
 from linebot.v3.webhook import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import Configuration, ApiClient, MessagingApi, ReplyMessageRequest
 from linebot.v3.messaging.models import TextMessage, ImageMessage
 from linebot.v3.webhooks import MessageEvent, TextMessageContent
+import atexit
+import hmac
 import image_generator
+import io
 import logging
 import os
+import random
 import re
+import signal
+import sys
+import threading
 import time
 import gcs_function
+import instrumentation
+import render_service
+import single_flight
+from byte_cache import ByteLRUCache
+from event_queue import EventQueue
 # 初始化日誌
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(module)s - %(funcName)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -17,6 +29,19 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET', 'YOUR_CHANNEL_SECRET')
 CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN', 'YOUR_CHANNEL_ACCESS_TOKEN')
+# 設定 Bot 對外的 HTTPS 網址後，新產生的圖片直接由 /images/ 路由提供，GCS 上傳改在背景進行
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL', '').rstrip('/')
+# 管理用路由 (如更新背景圖或 LOGO 後重新載入素材) 的權杖，未設定時停用管理路由
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+image_cache = ByteLRUCache(IMAGE_CACHE_MAX_BYTES)
+# 背景上傳失敗時以指數退避重試的次數與起始間隔 (秒)
+IMAGE_UPLOAD_RETRIES = int(os.environ.get('IMAGE_UPLOAD_RETRIES', 5))
+IMAGE_UPLOAD_RETRY_BASE_SECONDS = float(os.environ.get('IMAGE_UPLOAD_RETRY_BASE_SECONDS', 1.0))
+# Webhook 事件改由背景工作執行緒處理；EVENT_WORKER_COUNT=0 時維持在請求中同步處理
+EVENT_WORKER_COUNT = int(os.environ.get('EVENT_WORKER_COUNT', 4))
+EVENT_QUEUE_MAX_SIZE = int(os.environ.get('EVENT_QUEUE_MAX_SIZE', 200))
+EVENT_DRAIN_TIMEOUT_SECONDS = float(os.environ.get('EVENT_DRAIN_TIMEOUT_SECONDS', 25))
 try:
     line_config = Configuration(access_token=CHANNEL_ACCESS_TOKEN)
     line_bot_api = MessagingApi(ApiClient(line_config))
@@ -24,26 +49,77 @@ try:
 except Exception as e:
     logging.critical(f"初始化 LINE SDK 失敗: {e}")
     
+# 以 python app.py 執行時，spawn 啟動的繪圖子程序會以 __mp_main__ 的名稱重新匯入本檔；
+# 子程序由 render_service 自行初始化，以下的伺服器初始化與背景服務都不在子程序中執行
+IS_SPAWNED_CHILD = __name__ == "__mp_main__"
+
 # --- 初始化共用模組 ---
-try:
-    image_generator.initialize_dependencies()
-except Exception as e:
-    logging.critical("共用模組初始化失敗，應用程式可能無法正常運作！")
-    exit(1)
+if not IS_SPAWNED_CHILD:
+    try:
+        image_generator.initialize_dependencies()
+    except Exception as e:
+        logging.critical("共用模組初始化失敗，應用程式可能無法正常運作！")
+        exit(1)
+    if gcs_function.backend.kind != "gcs" and not PUBLIC_BASE_URL:
+        logger.warning(f"儲存後端為 {gcs_function.backend.kind}，未設定 PUBLIC_BASE_URL 時無法提供圖片網址給 LINE。")
 
 # --- LINE Bot 邏輯函式 ---
+# 物件名稱含內容雜湊，網址不需再加 cache_bust，LINE 與瀏覽器可以長期快取
+def gcs_image_url(gcs_path):
+    return f"https://storage.googleapis.com/{image_generator.GCS_BUCKET_NAME}/{gcs_path}"
+
+def bot_image_url(gcs_path):
+    image_key = gcs_path[len(image_generator.GCS_IMAGE_DIR) + 1:]
+    return f"{PUBLIC_BASE_URL}/images/{image_key}"
+
+def stored_image_url(gcs_path):
+    # 本機或記憶體儲存後端沒有公開網址，圖片只能經由 /images/ 路由提供 (需設定 PUBLIC_BASE_URL)
+    if gcs_function.backend.kind == "gcs":
+        return gcs_image_url(gcs_path)
+    return bot_image_url(gcs_path)
+
+def find_existing_image_urls(image_gcs_path, preview_gcs_path):
+    """已產生圖片的 (原圖網址, 預覽圖網址或 None)；尚未產生時回傳 (None, None)。"""
+    # 剛產生、仍在背景上傳中的圖片只存在於記憶體快取
+    if PUBLIC_BASE_URL and image_gcs_path in image_cache:
+        preview_url = bot_image_url(preview_gcs_path) if preview_gcs_path in image_cache else None
+        return bot_image_url(image_gcs_path), preview_url
+    if gcs_function.check_image_exists_gcs(image_gcs_path):
+        preview_url = stored_image_url(preview_gcs_path) if gcs_function.check_image_exists_gcs(preview_gcs_path) else None
+        return stored_image_url(image_gcs_path), preview_url
+    return None, None
+
+def _upload_in_background(png_bytes, preview_bytes, image_gcs_path, preview_gcs_path, flight):
+    # 回覆中的網址指向 /images/，圖片在上傳完成前只存在記憶體快取中：
+    # 上傳失敗時以指數退避重試，完成前圖片在快取中保持釘選，不會被淘汰。
+    # 上傳完成後才釋放執行權，其他 worker 程序等待後即可在 GCS 找到這張圖。
+    try:
+        for attempt in range(IMAGE_UPLOAD_RETRIES + 1):
+            try:
+                image_url, preview_url = gcs_function.upload_image_with_preview(
+                    io.BytesIO(png_bytes), io.BytesIO(preview_bytes) if preview_bytes else None, image_gcs_path, preview_gcs_path
+                )
+            except Exception as e:
+                logger.error(f"背景上傳座位圖時發生例外 ({image_gcs_path}): {e}", exc_info=True)
+                image_url = preview_url = None
+            if image_url is not None and (preview_bytes is None or preview_url is not None):
+                image_cache.unpin(image_gcs_path)
+                image_cache.unpin(preview_gcs_path)
+                return
+            if attempt < IMAGE_UPLOAD_RETRIES:
+                delay = IMAGE_UPLOAD_RETRY_BASE_SECONDS * (2 ** attempt) * random.uniform(0.5, 1.5)
+                logger.warning(f"背景上傳座位圖失敗，{delay:.1f} 秒後重試 ({attempt + 1}/{IMAGE_UPLOAD_RETRIES}): {image_gcs_path}")
+                time.sleep(delay)
+        # 仍保持釘選：這個程序繼續由 /images/ 提供圖片，已送出的網址不會失效
+        logger.error(f"背景上傳座位圖失敗，已重試 {IMAGE_UPLOAD_RETRIES} 次，圖片只保留在記憶體快取中: {image_gcs_path}")
+    finally:
+        flight.release()
+
 def find_customers_by_name(name_query):
-    name_query_lower = name_query.lower()
-    return [customer for customer in image_generator.customer_list if customer.get("name", "").lower() == name_query_lower]
-
-def find_customer_by_name_and_category(name_query, category_query, customer_options): # 查詢時使用原始中文名
-    name_query_lower = name_query.lower()
-    category_query_lower = category_query.lower() if category_query else ""
-    for cust in customer_options:
-        cust_category_lower = cust.get("category", "").lower() if cust.get("category") else ""
-        if cust.get("name", "").lower() == name_query_lower and cust_category_lower == category_query_lower:
-            return cust
-    return None
+    return image_generator.guest_index.find_by_name(name_query)
+
+def find_customer_by_name_and_category(name_query, category_query): # 查詢時使用原始中文名
+    return image_generator.guest_index.find_by_name_and_category(name_query, category_query)
 
 def send_seat_image_to_line(reply_token, customer_data, force_regenerate=False):
     customer_name_original = customer_data.get("name")
@@ -57,14 +133,29 @@ def send_seat_image_to_line(reply_token, customer_data, force_regenerate=False):
         )
         return
 
-    image_gcs_path = image_generator.get_gcs_image_path_for_customer(customer_name_original, customer_category_original)
+    # 座位共用模式下，同一座位的賓客共用一張不含姓名的圖，問候語改以文字訊息發送
+    share_by_seat = image_generator.is_seat_sharing_mode()
+    if share_by_seat:
+        base_gcs_path = image_generator.get_gcs_image_path_for_seat(target_seat_id)
+        name_on_image = None
+    else:
+        base_gcs_path = image_generator.get_gcs_image_path_for_customer(customer_name_original, customer_category_original)
+        name_on_image = customer_name_original
+    content_hash = image_generator.image_content_hash(target_seat_id, name_on_image)
+    image_gcs_path = image_generator.versioned_image_path_for_hash(base_gcs_path, content_hash)
+    preview_gcs_path = image_generator.get_preview_gcs_path(image_gcs_path)
     image_url = None
+    preview_url = None  # 沒有預覽圖時以原圖代替
     logger.info(f"處理請求: 賓客='{customer_name_original}', 分類='{customer_category_original if customer_category_original else '無'}', 座位='{target_seat_id}'. GCS 路徑='{image_gcs_path}'")
 
-    if not force_regenerate and gcs_function.check_image_exists_gcs(image_gcs_path):
-        timestamp = int(time.time())
-        image_url = f"https://storage.googleapis.com/{image_generator.GCS_BUCKET_NAME}/{image_gcs_path}?cache_bust={timestamp}"
-        logger.info(f"使用 GCS 圖片: {image_url} (GCS 路徑: {image_gcs_path})")
+    instrumentation.annotate(seat=target_seat_id, force_regenerate=force_regenerate)
+    with instrumentation.phase("check_exists"):
+        if not force_regenerate:
+            image_url, preview_url = find_existing_image_urls(image_gcs_path, preview_gcs_path)
+    instrumentation.annotate(cache_hit=image_url is not None)
+
+    if image_url:
+        logger.info(f"使用已產生的圖片: {image_url} (GCS 路徑: {image_gcs_path})")
     else:
         log_reason = "強制重新生成" if force_regenerate else "快取未命中"
         logger.info(f"{log_reason}，為 '{customer_name_original}' (分類:'{customer_category_original if customer_category_original else '無'}', 座位:'{target_seat_id}') 產生新圖片。")
@@ -72,17 +163,60 @@ def send_seat_image_to_line(reply_token, customer_data, force_regenerate=False):
         if target_seat_id not in image_generator.table_locations:
             logger.warning(f"請求的座位ID '{target_seat_id}' 在 table_locations.json 中不存在。")
 
-        image_io = image_generator.create_seat_image(target_seat_id, customer_name_original)
-        if image_io:
-            gcs_function.upload_to_gcs(image_io, image_gcs_path)
-            timestamp = int(time.time())
-            image_url = f"https://storage.googleapis.com/{image_generator.GCS_BUCKET_NAME}/{image_gcs_path}?cache_bust={timestamp}"
-        else:
-            logger.error(f"為 '{customer_name_original}' (座位:'{target_seat_id}') 產生座位圖失敗。")
-            line_bot_api.reply_message(
-                ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text="抱歉，為您產生座位圖時發生錯誤。")])
-            )
-            return
+        # 同一張圖同時只由一個請求繪製與上傳 (跨執行緒與 worker 程序)，其他請求等待後直接使用結果；
+        # 同一程序內的等待者在圖片放入記憶體快取後即可回覆，不必等背景上傳
+        flight = single_flight.acquire(
+            image_gcs_path, is_done=lambda: bool(PUBLIC_BASE_URL) and image_gcs_path in image_cache
+        )
+        try:
+            if flight.waited:
+                image_url, preview_url = find_existing_image_urls(image_gcs_path, preview_gcs_path)
+                instrumentation.annotate(coalesced=image_url is not None)
+                if image_url:
+                    logger.info(f"等待期間已由其他請求產生: {image_url}")
+            if not image_url:
+                with instrumentation.phase("render"):
+                    result = render_service.render(target_seat_id, name_on_image, expected_hash=content_hash)
+                png_bytes, preview_bytes = result.png_bytes, result.preview_bytes
+                if png_bytes and result.content_hash != content_hash:
+                    # 繪圖子程序使用的素材版本與本程序不同：物件名稱以圖片實際的內容為準，
+                    # 避免舊素材的圖片被存到新版本的名稱下
+                    image_gcs_path = image_generator.versioned_image_path_for_hash(base_gcs_path, result.content_hash)
+                    preview_gcs_path = image_generator.get_preview_gcs_path(image_gcs_path)
+                if png_bytes and PUBLIC_BASE_URL and image_cache.put(image_gcs_path, png_bytes, pin=True):
+                    # 先以 Bot 自己的網址回覆，GCS 上傳不佔用回覆時間；執行權交給背景上傳釋放
+                    image_url = bot_image_url(image_gcs_path)
+                    if preview_bytes and image_cache.put(preview_gcs_path, preview_bytes, pin=True):
+                        preview_url = bot_image_url(preview_gcs_path)
+                    else:
+                        image_cache.pop(preview_gcs_path)  # 避免重新生成後仍提供舊的預覽圖
+                    # 同一程序內的等待者已能從記憶體快取取得圖片；鎖定檔留到上傳完成，其他 worker 程序等待後從 GCS 讀取
+                    flight.release_local()
+                    threading.Thread(
+                        target=_upload_in_background, args=(png_bytes, preview_bytes, image_gcs_path, preview_gcs_path, flight),
+                        name="gcs-upload", daemon=True
+                    ).start()
+                    flight = None
+                elif png_bytes:
+                    # 圖片超過快取上限時不經記憶體快取，移除可能殘留的舊版本
+                    image_cache.pop(image_gcs_path)
+                    image_cache.pop(preview_gcs_path)
+                    with instrumentation.phase("upload"):
+                        _, uploaded_preview_url = gcs_function.upload_image_with_preview(
+                            io.BytesIO(png_bytes), io.BytesIO(preview_bytes) if preview_bytes else None, image_gcs_path, preview_gcs_path
+                        )
+                    image_url = stored_image_url(image_gcs_path)
+                    if uploaded_preview_url:
+                        preview_url = stored_image_url(preview_gcs_path)
+                else:
+                    logger.error(f"為 '{customer_name_original}' (座位:'{target_seat_id}') 產生座位圖失敗。")
+                    line_bot_api.reply_message(
+                        ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text="抱歉，為您產生座位圖時發生錯誤。")])
+                    )
+                    return
+        finally:
+            if flight is not None:
+                flight.release()
 
     if image_url:
         if not image_url.startswith("https://"):
@@ -91,13 +225,17 @@ def send_seat_image_to_line(reply_token, customer_data, force_regenerate=False):
                 ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text="抱歉，圖片連結錯誤，無法顯示。")])
             )
             return
+        messages = [ImageMessage(original_content_url=image_url, preview_image_url=preview_url or image_url)]
+        if share_by_seat:
+            messages.insert(0, TextMessage(text=image_generator.build_prompt(target_seat_id, customer_name_original)))
         try:
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[ImageMessage(original_content_url=image_url, preview_image_url=image_url)]
+            with instrumentation.phase("line_reply"):
+                line_bot_api.reply_message(
+                    ReplyMessageRequest(
+                        reply_token=reply_token,
+                        messages=messages
+                    )
                 )
-            )
             logger.info(f"圖片已成功發送給 '{customer_name_original}'.")
         except Exception as e:
             logger.error(f"透過 LINE 發送圖片失敗 ({image_url}): {e}")
@@ -121,20 +259,105 @@ user_state = {}
 def home():
     return "LINE Bot for Seat Assignment (MarryMe) is running!"
 
+@app.route('/images/<path:image_key>')
+def serve_image(image_key):
+    # 只提供座位圖目錄下的物件；尚在背景上傳中的圖片只在 image_cache，其餘經由 gcs_function 的快取鏈讀取
+    if ".." in image_key.split("/"):
+        abort(404)
+    gcs_path = f"{image_generator.GCS_IMAGE_DIR}/{image_key}"
+    data = image_cache.get(gcs_path)
+    if data is None:
+        image_io = gcs_function.download_from_gcs(gcs_path, immutable=True)
+        if image_io is None:
+            abort(404)
+        data = image_io.getvalue()
+    mimetype = 'image/jpeg' if image_key.endswith('.jpg') else 'image/png'
+    response = Response(data, mimetype=mimetype)
+    response.headers['Cache-Control'] = gcs_function.IMMUTABLE_CACHE_CONTROL
+    return response
+
+@app.route('/admin/reload-assets', methods=['POST'])
+def admin_reload_assets():
+    # 在 GCS 上更換背景圖或 LOGO 後呼叫，不必等素材快取到期；繪圖子程序在下一個工作前跟著重新驗證
+    token = request.headers.get('X-Admin-Token', '')
+    if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+        abort(403)
+    asset_epoch = render_service.reload_assets()
+    logger.info(f"已透過管理路由重新載入素材 (第 {asset_epoch} 次)。")
+    return jsonify({"asset_epoch": asset_epoch, "asset_version": image_generator.current_asset_version()})
+
+@app.route('/metrics')
+def metrics():
+    return jsonify({
+        "event_queue": event_queue.stats() if event_queue else None,
+        "image_cache": image_cache.stats(),
+        "storage_cache": gcs_function.storage_cache_stats(),
+    })
+
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
+    if event_queue is None:
+        try:
+            handler.handle(body, signature)
+        except InvalidSignatureError:
+            abort(400)
+        except Exception as e:
+            abort(500)
+        return 'OK'
+
+    # 只驗證簽章並放入佇列就回應，查詢、繪圖與回覆由工作執行緒處理
     try:
-        handler.handle(body, signature)
+        events = handler.parser.parse(body, signature)
     except InvalidSignatureError:
         abort(400)
     except Exception as e:
+        logger.error(f"解析 webhook 內容失敗: {e}", exc_info=True)
         abort(500)
+    if not event_queue.submit_batch(events):
+        abort(503)
     return 'OK'
 
 @handler.add(MessageEvent, message=TextMessageContent)
-def handle_message(event: MessageEvent): 
+def handle_message(event: MessageEvent):
+    # 每個事件一個 trace，結束時輸出一行各階段耗時的日誌
+    with instrumentation.trace_request(getattr(event, "webhook_event_id", None), user_id=event.source.user_id):
+        handle_text_message(event)
+
+def dispatch_event(event):
+    # 與 @handler.add 註冊的處理對象相同：只處理文字訊息
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+        handle_message(event)
+    else:
+        logger.info(f"略過不處理的事件類型: {type(event).__name__}")
+
+event_queue = None
+
+def start_background_services():
+    """啟動只屬於伺服器程序的背景服務：繪圖程序池、圖片存在索引與事件佇列。"""
+    global event_queue
+    # --- 繪圖程序池 (RENDER_PROCESSES=0 時在請求執行緒中繪製) ---
+    render_service.start()
+    atexit.register(render_service.shutdown)
+
+    # --- 已產生圖片的存在索引 (失敗時退回逐次查詢 GCS) ---
+    try:
+        gcs_function.load_existence_index(f"{image_generator.GCS_IMAGE_DIR}/")
+        gcs_function.start_existence_reconciler()
+    except Exception as e:
+        logger.error(f"載入圖片存在索引失敗，將逐次查詢 GCS: {e}", exc_info=True)
+
+    if EVENT_WORKER_COUNT > 0:
+        event_queue = EventQueue(dispatch_event, EVENT_WORKER_COUNT, EVENT_QUEUE_MAX_SIZE)
+        event_queue.start()
+        # gunicorn worker 正常結束時會執行 atexit，先處理完已收下的事件
+        atexit.register(event_queue.shutdown, EVENT_DRAIN_TIMEOUT_SECONDS)
+
+if not IS_SPAWNED_CHILD:
+    start_background_services()
+
+def handle_text_message(event: MessageEvent): 
     user_id = event.source.user_id
     text = event.message.text.strip()
     reply_token = event.reply_token
@@ -162,8 +385,7 @@ def handle_message(event: MessageEvent):
         if "_" in query_content:
             potential_name, _, potential_category = query_content.rpartition("_") # 從右邊分割，處理名字本身可能含有的底線
             # 檢查 potential_name 是否有效，以及 potential_category 是否真的是一個分類
-            temp_customers_for_check = find_customers_by_name(potential_name)
-            customer_check = find_customer_by_name_and_category(potential_name, potential_category, temp_customers_for_check)
+            customer_check = find_customer_by_name_and_category(potential_name, potential_category)
             if customer_check:
                 name_to_process_orig = potential_name
                 category_to_process_orig = potential_category
@@ -176,16 +398,15 @@ def handle_message(event: MessageEvent):
         
         target_customers_for_regen = []
         if name_to_process_orig:
-            matching_by_name = find_customers_by_name(name_to_process_orig)
             if category_to_process_orig is not None:
-                customer = find_customer_by_name_and_category(name_to_process_orig, category_to_process_orig, matching_by_name)
+                customer = find_customer_by_name_and_category(name_to_process_orig, category_to_process_orig)
                 if customer:
                     target_customers_for_regen = [customer]
                 else:
                     line_bot_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=f"找不到賓客 '{name_to_process_orig}' (分類: {category_to_process_orig if category_to_process_orig else '無'}) 可重新生成。")]))
                     return
             else: # 指令中未給分類
-                target_customers_for_regen = matching_by_name
+                target_customers_for_regen = find_customers_by_name(name_to_process_orig)
         
         if not target_customers_for_regen:
             line_bot_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=f"找不到賓客 '{name_to_process_orig}' 的資料可重新生成。")]))
@@ -280,8 +501,7 @@ def handle_message(event: MessageEvent):
     if potential_name_orig: # 確保 potential_name_orig 不是空的
         # 先嘗試精確匹配 (姓名 + 分類，如果分類被解析出來)
         if potential_category_orig is not None: # 即使是空字串也算解析出分類意圖
-            all_with_name = find_customers_by_name(potential_name_orig)
-            customer = find_customer_by_name_and_category(potential_name_orig, potential_category_orig, all_with_name)
+            customer = find_customer_by_name_and_category(potential_name_orig, potential_category_orig)
             if customer:
                 found_customers = [customer]
         
@@ -289,6 +509,23 @@ def handle_message(event: MessageEvent):
         if not found_customers:
             found_customers = find_customers_by_name(potential_name_orig) # 如果上面沒解析出分類，這裡的 potential_name_orig 就是原始 text
 
+    if not found_customers and potential_name_orig:
+        # 沒有中文姓名相符時，嘗試以拼音查詢 (如 "chen yanyan" 或 "cyy")
+        found_customers = image_generator.guest_index.find_by_romanization(potential_name_orig)
+        if found_customers:
+            logger.info(f"以拼音 '{potential_name_orig}' 找到 {len(found_customers)} 位賓客。")
+
+    if not found_customers and potential_name_orig:
+        # 找不到完全相符的姓名時，以容錯查詢提供候選名單，沿用下方的選項回覆流程
+        fuzzy_candidates = image_generator.guest_index.fuzzy_search(potential_name_orig)
+        if fuzzy_candidates:
+            logger.info(f"'{potential_name_orig}' 無完全相符，模糊查詢找到 {len(fuzzy_candidates)} 位候選賓客。")
+            options_text = [f"{idx+1}. {cust['name']} ({cust.get('category','無')})" for idx, cust in enumerate(fuzzy_candidates)]
+            reply_msg = f"找不到「{potential_name_orig}」，請問您是不是要找以下賓客？ (請回覆數字或完整選項)：\n" + "\n".join(options_text)
+            user_state[user_context_key_options] = fuzzy_candidates
+            line_bot_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=reply_msg)]))
+            return
+
     if not found_customers:
         logger.info(f"找不到賓客: '{text}'")
         line_bot_api.reply_message(
@@ -311,5 +548,8 @@ if __name__ == "__main__":
     if not image_generator.table_locations:
         logger.warning("警告：桌位佈局為空。無法產生座位圖。")
 
+    # 直接執行時 SIGTERM 預設不會觸發 atexit，改為正常結束以排空事件佇列 (gunicorn 自行處理訊號)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     port = int(os.environ.get("PORT", 8080))
     app.run(host="0.0.0.0", port=port, debug=False)
\ No newline at end of file
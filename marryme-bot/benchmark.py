@@ -0,0 +1,72 @@
+import argparse
+import logging
+import statistics
+import time
+import image_generator
+
+# 基準測試：比較各繪製模式繪製單張座位圖的 CPU 時間 (繪製與 PNG 編碼分開計時)，以及各 PNG 輸出模式的檔案大小與編碼時間
+# 用法：python benchmark.py --key marryme-461108-796e200900bb.json --count 50
+
+logger = logging.getLogger(__name__)
+
+def benchmark_render_mode(render_mode, seat_ids, count, background_alignment):
+    """回傳 (繪製耗時, 編碼耗時) 兩組毫秒數；繪製只計 render_seat_canvas，編碼成本另外列出，不掩蓋繪製模式的差異。"""
+    # 每個座位先繪製一次作為暖機 (下載素材、建立底圖與高亮小圖)，不列入統計，各模式都以穩定狀態比較
+    for seat_id in seat_ids:
+        image_generator.render_seat_canvas(seat_id, "暖機", background_alignment, render_mode=render_mode)
+    render_ms = []
+    encode_ms = []
+    for i in range(count):
+        seat_id = seat_ids[i % len(seat_ids)]
+        start = time.process_time()
+        img = image_generator.render_seat_canvas(seat_id, "測試賓客", background_alignment, render_mode=render_mode)
+        render_ms.append((time.process_time() - start) * 1000)
+        start = time.process_time()
+        image_generator.encode_png_with_stats(img)
+        encode_ms.append((time.process_time() - start) * 1000)
+    return render_ms, encode_ms
+
+def benchmark_png_encoding(seat_ids, count, background_alignment, output_modes, compress_levels):
+    canvases = [image_generator.render_seat_canvas(seat_ids[i % len(seat_ids)], "測試賓客", background_alignment)
+                for i in range(min(count, len(seat_ids)))]
+    print(f"{'PNG 模式':<10}{'壓縮等級':>8}{'平均大小(bytes)':>18}{'平均編碼(ms)':>14}")
+    for output_mode in output_modes:
+        for compress_level in compress_levels:
+            results = [image_generator.encode_png_with_stats(img, output_mode, compress_level)[1] for img in canvases]
+            avg_bytes = statistics.mean(r["bytes"] for r in results)
+            avg_ms = statistics.mean(r["encode_ms"] for r in results)
+            print(f"{output_mode:<10}{compress_level:>8}{avg_bytes:>18.0f}{avg_ms:>14.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="座位圖繪製模式基準測試")
+    parser.add_argument("--key", default=None, help="GCS 服務帳號金鑰檔 (與 pre.py 相同)")
+    parser.add_argument("--count", type=int, default=50, help="每種模式產生的圖片數")
+    parser.add_argument("--alignment", default="延展", help="背景對齊方式")
+    parser.add_argument("--modes", default="full,layered,sprite", help="要比較的繪製模式，以逗號分隔")
+    parser.add_argument("--png-modes", default="rgba,palette", help="要比較的 PNG 輸出模式，以逗號分隔")
+    parser.add_argument("--compress-levels", default="1,6,9", help="要比較的 PNG 壓縮等級，以逗號分隔")
+    args = parser.parse_args()
+
+    image_generator.initialize_dependencies(args.key)
+    seat_ids = [seat_id for seat_id in image_generator.table_locations]
+    if not seat_ids:
+        logger.error("桌位資料為空，無法進行基準測試。")
+        return
+
+    # 關閉繪圖過程中的 INFO 日誌，避免影響計時
+    logging.getLogger(image_generator.__name__).setLevel(logging.WARNING)
+
+    print(f"{'模式':<10}{'繪製平均(ms)':>14}{'繪製中位數(ms)':>16}{'繪製P95(ms)':>13}{'編碼平均(ms)':>14}")
+    for render_mode in args.modes.split(","):
+        render_ms, encode_ms = benchmark_render_mode(render_mode, seat_ids, args.count, args.alignment)
+        render_ms.sort()
+        p95 = render_ms[min(len(render_ms) - 1, int(len(render_ms) * 0.95))]
+        print(f"{render_mode:<10}{statistics.mean(render_ms):>14.2f}{statistics.median(render_ms):>16.2f}{p95:>13.2f}"
+              f"{statistics.mean(encode_ms):>14.2f}")
+
+    print()
+    benchmark_png_encoding(seat_ids, args.count, args.alignment, args.png_modes.split(","),
+                           [int(level) for level in args.compress_levels.split(",")])
+
+if __name__ == "__main__":
+    main()
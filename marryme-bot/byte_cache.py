@@ -0,0 +1,233 @@
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows 本機執行時只在同一程序內排隊
+    fcntl = None
+
+# 以總位元組數為上限的 LRU 快取，存放已編碼的圖片 (PNG/JPEG bytes) 與從儲存後端讀取的物件。
+# ByteLRUCache 在記憶體中 (每個程序各一份)，DiskLRUCache 在本機磁碟上 (同一目錄的所有程序共用上限)。
+# 超過上限時從最久未使用的項目開始淘汰；單一項目大於上限時不快取。
+# ByteLRUCache 的項目可以釘選 (如尚未上傳完成的圖片)，釘選期間不會被淘汰。
+
+class ByteLRUCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max(0, int(max_bytes))
+        self._entries = OrderedDict()  # key -> bytes，越後面越常用
+        self._pinned = set()  # 不可淘汰的 key
+        self._size_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data, pin=False):
+        """
+        寫入項目；pin 為 True 時釘選，直到 unpin(key) 前不會被淘汰。
+        釘選的項目仍計入總大小，剩下的都是釘選項目時可暫時超過上限。
+        """
+        data = bytes(data)
+        if len(data) > self.max_bytes:
+            return False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size_bytes -= len(old)
+            self._entries[key] = data
+            self._size_bytes += len(data)
+            if pin:
+                self._pinned.add(key)
+            self._evict_locked()
+        return True
+
+    def _evict_locked(self):
+        for key in list(self._entries):
+            if self._size_bytes <= self.max_bytes:
+                break
+            if key in self._pinned:
+                continue
+            evicted = self._entries.pop(key)
+            self._size_bytes -= len(evicted)
+            self.evictions += 1
+
+    def unpin(self, key):
+        """取消釘選，項目回到一般的 LRU 淘汰順序。"""
+        with self._lock:
+            self._pinned.discard(key)
+            self._evict_locked()
+
+    def pop(self, key):
+        with self._lock:
+            self._pinned.discard(key)
+            data = self._entries.pop(key, None)
+            if data is not None:
+                self._size_bytes -= len(data)
+            return data
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size_bytes,
+                "max_bytes": self.max_bytes,
+                "pinned": len(self._pinned),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+class DiskLRUCache:
+    """
+    以總位元組數為上限的本機磁碟快取，介面與 ByteLRUCache 相同。
+    每個項目存成 root 下的一個檔案 (檔名為 key 的雜湊)，檔案修改時間即使用順序。
+    目錄本身就是索引：同一台機器上的多個程序 (gunicorn worker、繪圖子程序) 共用同一目錄時，
+    寫入後在目錄鎖 (flock) 內掃描整個目錄並淘汰最舊的檔案，上限是所有程序合計的大小。
+    檔案被其他程序淘汰時視為未命中。
+    """
+
+    _LOCK_FILE_NAME = ".lock"
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max(0, int(max_bytes))
+        self._lock = threading.Lock()
+        self._entry_count = 0  # 最近一次掃描的結果
+        self._size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+        with self._directory_lock():
+            self._evict_locked()
+
+    @staticmethod
+    def _file_name(key):
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    @contextmanager
+    def _directory_lock(self):
+        # 程序內以 threading.Lock 排隊，程序間以目錄下的鎖定檔排隊
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.root, self._LOCK_FILE_NAME), "a") as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _scan(self):
+        files = []
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.name == self._LOCK_FILE_NAME or entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime_ns, entry.name, st.st_size))
+        files.sort()
+        return files
+
+    def _evict_locked(self):
+        # 需持有目錄鎖；從修改時間最舊的檔案開始刪除，直到合計大小不超過上限
+        files = self._scan()
+        size_bytes = sum(size for _, _, size in files)
+        count = len(files)
+        for _, file_name, size in files:
+            if size_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.root, file_name))
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            size_bytes -= size
+            count -= 1
+        self._entry_count = count
+        self._size_bytes = size_bytes
+
+    def __len__(self):
+        return self._entry_count
+
+    def __contains__(self, key):
+        return os.path.isfile(os.path.join(self.root, self._file_name(key)))
+
+    def get(self, key):
+        file_path = os.path.join(self.root, self._file_name(key))
+        try:
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            os.utime(file_path)  # 更新修改時間，所有程序的淘汰順序都以此為準
+        except FileNotFoundError:
+            data = None
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def put(self, key, data):
+        data = bytes(data)
+        if len(data) > self.max_bytes:
+            return False
+        file_path = os.path.join(self.root, self._file_name(key))
+        # 先寫入暫存檔再取代，其他程序不會讀到寫到一半的檔案
+        tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            with self._directory_lock():
+                os.replace(tmp_path, file_path)
+                self._evict_locked()
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return True
+
+    def pop(self, key):
+        file_path = os.path.join(self.root, self._file_name(key))
+        try:
+            size = os.path.getsize(file_path)
+            os.remove(file_path)
+        except FileNotFoundError:
+            return None
+        return size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": self._entry_count,
+                "bytes": self._size_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
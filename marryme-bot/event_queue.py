@@ -0,0 +1,148 @@
+import logging
+import threading
+import time
+from collections import deque
+
+# Webhook 事件的背景處理佇列：/callback 驗證簽章後把事件放入佇列就回應 200，
+# 由固定數量的工作執行緒查詢、繪圖與回覆。
+# 所有工作執行緒共用一個有上限的佇列，任何空閒的執行緒都能取下一個事件，一個慢的事件不會擋住其他賓客。
+# 同一位使用者同時只有一個事件在處理：該使用者的後續事件留在佇列中，等前一個完成後才被取出，
+# 確保「選項回覆」等前後相依的訊息依序處理。
+
+logger = logging.getLogger(__name__)
+
+class EventQueue:
+    def __init__(self, dispatch, worker_count, max_size):
+        self.dispatch = dispatch
+        self.worker_count = max(1, int(worker_count))
+        self.max_size = max(1, int(max_size))
+        self._pending = deque()  # (event, user_id, enqueued_at)，依到達順序
+        self._active_users = set()  # 目前有事件正在處理的使用者
+        self._cond = threading.Condition()
+        self._workers = []
+        self._closed = False
+        self._stopping = False
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.max_wait_ms = 0.0
+        self._total_wait_ms = 0.0
+
+    def start(self):
+        for index in range(self.worker_count):
+            worker = threading.Thread(target=self._run_worker, name=f"event-worker-{index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        logger.info(f"事件佇列已啟動: {self.worker_count} 個工作執行緒，上限 {self.max_size} 個事件。")
+
+    @staticmethod
+    def _user_id(event):
+        # 沒有使用者 ID 的事件不需要依序處理
+        source = getattr(event, "source", None)
+        return getattr(source, "user_id", None)
+
+    def submit_batch(self, events):
+        """
+        把同一個 webhook 請求的事件全部放入佇列；空間不足時一個都不放並回傳 False，
+        讓 LINE 重送時不會有部分事件被處理兩次。
+        """
+        events = list(events)
+        with self._cond:
+            rejected = self._closed or len(self._pending) + len(events) > self.max_size
+            if rejected:
+                self.rejected += len(events)
+                queued = len(self._pending)
+            else:
+                enqueued_at = time.monotonic()
+                for event in events:
+                    self._pending.append((event, self._user_id(event), enqueued_at))
+                self.accepted += len(events)
+                self._cond.notify_all()
+        if rejected:
+            logger.warning(f"事件佇列已滿或正在關閉，拒絕 {len(events)} 個事件 (目前 {queued} 個待處理)。")
+        return not rejected
+
+    def _take_next_locked(self):
+        # 取最早的一個「使用者目前沒有事件在處理」的事件；同一使用者較早的事件一定排在前面，順序不變
+        for index, (_, user_id, _) in enumerate(self._pending):
+            if user_id is None or user_id not in self._active_users:
+                item = self._pending[index]
+                del self._pending[index]
+                return item
+        return None
+
+    def _run_worker(self):
+        while True:
+            with self._cond:
+                item = None
+                while not self._stopping:
+                    item = self._take_next_locked()
+                    if item is not None:
+                        break
+                    self._cond.wait()
+                if item is None:
+                    return
+                event, user_id, enqueued_at = item
+                if user_id is not None:
+                    self._active_users.add(user_id)
+                wait_ms = (time.monotonic() - enqueued_at) * 1000
+                self.in_flight += 1
+                self._total_wait_ms += wait_ms
+                self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+            failed = False
+            try:
+                self.dispatch(event)
+            except Exception as e:
+                failed = True
+                logger.error(f"處理事件失敗: {e}", exc_info=True)
+            with self._cond:
+                if user_id is not None:
+                    self._active_users.discard(user_id)
+                self.in_flight -= 1
+                self.processed += 1
+                self.failed += failed
+                # 這位使用者的下一個事件可能正在等待，喚醒所有執行緒重新挑選
+                self._cond.notify_all()
+
+    def queued(self):
+        with self._cond:
+            return len(self._pending)
+
+    def stats(self):
+        with self._cond:
+            started = self.processed + self.in_flight
+            return {
+                "workers": self.worker_count,
+                "max_size": self.max_size,
+                "queued": len(self._pending),
+                "in_flight": self.in_flight,
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "processed": self.processed,
+                "failed": self.failed,
+                "avg_wait_ms": round(self._total_wait_ms / started, 2) if started else 0.0,
+                "max_wait_ms": round(self.max_wait_ms, 2),
+                "closed": self._closed,
+            }
+
+    def shutdown(self, timeout):
+        """停止接收新事件，等待已排入的事件處理完畢 (最多 timeout 秒) 後結束工作執行緒。"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            logger.info(f"事件佇列關閉中，等待 {len(self._pending) + self.in_flight} 個事件處理完畢...")
+            while (self._pending or self.in_flight) and time.monotonic() < deadline:
+                self._cond.wait(max(0.0, deadline - time.monotonic()))
+            self._stopping = True
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+        remaining = self.queued()
+        if remaining:
+            logger.warning(f"事件佇列關閉逾時，仍有 {remaining} 個事件未處理。")
+        else:
+            logger.info("事件佇列已關閉，所有事件處理完畢。")
@@ -2,18 +2,66 @@ import os
 import io
 import time
 import logging
+import tempfile
+import threading
+import storage_backend
+from byte_cache import ByteLRUCache, DiskLRUCache
 
 logger = logging.getLogger(__name__)
-bucket = None  # 由外部初始化
+backend = None  # 儲存後端 (storage_backend)，由外部初始化
+
+# 靜態素材 (背景圖、LOGO) 的記憶體快取：超過此秒數才以 metadata 請求確認 generation 是否改變
+ASSET_REVALIDATE_SECONDS = int(os.environ.get('ASSET_REVALIDATE_SECONDS', 300))
+_asset_cache = {}  # gcs_path -> {"data": bytes 或 None, "generation": ..., "etag": ..., "checked_at": monotonic 秒}
+_asset_cache_lock = threading.Lock()
+
+# 已產生圖片的存在索引：啟動時列出一次，上傳成功後加入，並定期在背景與 GCS 對帳
+EXISTENCE_RECONCILE_SECONDS = int(os.environ.get('EXISTENCE_RECONCILE_SECONDS', 600))
+_existing_objects = None  # 尚未載入時為 None，此時退回逐次 blob.exists()
+_existence_prefix = ""
+_existence_lock = threading.Lock()
+_reconciler_thread = None
+
+# 產生的圖片以內容雜湊命名，同一物件名稱的內容永遠不變
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# 讀取物件的快取鏈：記憶體 LRU -> 本機磁碟 LRU -> 儲存後端。快取鍵為「物件路徑#generation」，
+# 物件更新後 generation 改變，舊內容不會再被讀到，之後由 LRU 淘汰。
+# 磁碟快取只在 GCS 後端啟用 (本機與記憶體後端本身不經網路)，預設停用 (STORAGE_DISK_CACHE_MAX_BYTES=0)：
+# Cloud Run 的 /tmp 佔用容器記憶體，放在那裡不會比記憶體快取省。有實體磁碟時才設定上限，
+# 並以 STORAGE_DISK_CACHE_DIR 指向該磁碟；上限由同一目錄的所有程序共用。
+STORAGE_MEMORY_CACHE_MAX_BYTES = int(os.environ.get('STORAGE_MEMORY_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+STORAGE_DISK_CACHE_DIR = os.environ.get('STORAGE_DISK_CACHE_DIR', os.path.join(tempfile.gettempdir(), "marryme-storage-cache"))
+STORAGE_DISK_CACHE_MAX_BYTES = int(os.environ.get('STORAGE_DISK_CACHE_MAX_BYTES', 0))
+_IMMUTABLE_GENERATION = "immutable"  # 以內容命名的物件不需確認 generation
+_READ_ATTEMPTS = 3  # 讀取 metadata 後物件又被覆寫時，重新讀取的次數上限
+memory_cache = ByteLRUCache(STORAGE_MEMORY_CACHE_MAX_BYTES)
+disk_cache = None
+_backend_stats = {"hits": 0, "misses": 0}  # 實際向儲存後端下載的次數 (找到 / 不存在)
+_backend_stats_lock = threading.Lock()
+
+def init_storage(storage):
+    global backend, disk_cache
+    backend = storage
+    logger.info(f"儲存後端: {storage.kind} ({storage.name})")
+    disk_cache = None
+    if storage.kind == "gcs" and STORAGE_DISK_CACHE_MAX_BYTES > 0:
+        try:
+            disk_cache = DiskLRUCache(STORAGE_DISK_CACHE_DIR, STORAGE_DISK_CACHE_MAX_BYTES)
+            logger.info(f"磁碟快取: {STORAGE_DISK_CACHE_DIR} (上限 {STORAGE_DISK_CACHE_MAX_BYTES // (1024 * 1024)} MB，現有 {len(disk_cache)} 個檔案)")
+        except OSError as e:
+            logger.warning(f"無法建立磁碟快取 ({STORAGE_DISK_CACHE_DIR})，僅使用記憶體快取: {e}")
 
 def init_bucket(external_bucket):
-    global bucket
-    bucket = external_bucket
+    init_storage(storage_backend.GCSStorage(external_bucket))
 
-def upload_to_gcs(image_io, gcs_path, save_local=False):
-    global bucket
+def _backup_enabled(save_local):
+    # 本機與記憶體後端的物件本來就不在雲端，不需要再備份一份到 local_backup/
+    return save_local and backend.kind == "gcs"
+
+def upload_to_gcs(image_io, gcs_path, save_local=False, content_type='image/png', cache_control=None):
+    save_local = _backup_enabled(save_local)
     try:
-        blob = bucket.blob(gcs_path)
         if save_local:
             local_path = os.path.join("local_backup", os.path.basename(gcs_path))
             os.makedirs(os.path.dirname(local_path), exist_ok=True)
@@ -22,39 +70,115 @@ def upload_to_gcs(image_io, gcs_path, save_local=False):
                 f.write(image_io.read())
                 image_io.seek(0)
 
-        blob.upload_from_file(image_io, content_type='image/png')
-        logger.info(f"圖片已上傳至 GCS: gs://{bucket.name}/{gcs_path}" +
+        backend.put(gcs_path, image_io.getvalue(), content_type=content_type, cache_control=cache_control)
+        mark_object_exists(gcs_path)
+        logger.info(f"圖片已上傳至 GCS: {backend.uri(gcs_path)}" +
                     (f"，本地備份：{local_path}" if save_local else ""))
-        return f"https://storage.googleapis.com/{bucket.name}/{gcs_path}"
+        return backend.public_url(gcs_path)
     except Exception as e:
         logger.error(f"上傳圖片到 GCS 失败 ({gcs_path}): {e}", exc_info=True)
         return None
     
+def upload_image_with_preview(image_io, preview_io, gcs_path, preview_gcs_path, save_local=False):
+    """上傳原圖與 LINE 預覽圖；預覽圖失敗不影響原圖，回傳 (原圖 URL, 預覽圖 URL 或 None)。"""
+    image_url = upload_to_gcs(image_io, gcs_path, save_local=save_local, cache_control=IMMUTABLE_CACHE_CONTROL)
+    if image_url is None:
+        return None, None
+    preview_url = None
+    if preview_io is not None:
+        preview_url = upload_to_gcs(preview_io, preview_gcs_path, save_local=save_local, content_type='image/jpeg',
+                                    cache_control=IMMUTABLE_CACHE_CONTROL)
+    return image_url, preview_url
+
 def force_download_from_gcs(gcs_path):
-    from google.cloud import storage
-    global bucket
-    blob = bucket.blob(gcs_path)
-    
-    if not blob.exists():
+    data = backend.get(gcs_path)
+
+    if data is None:
         print(f"[ERROR] blob 不存在: {gcs_path}")
         return None
-    
-    image_io = io.BytesIO()
-    blob.download_to_file(image_io)
-    image_io.seek(0)
+
+    image_io = io.BytesIO(data)
     
     print(f"[OK] 成功下載: {gcs_path}")
     
     return image_io
 
-def download_from_gcs(gcs_path, save_local=False):
-    global bucket
+def _cache_key(gcs_path, generation):
+    return f"{gcs_path}#{generation}"
+
+def _read_through(gcs_path, generation):
+    """依序查詢記憶體快取、磁碟快取與儲存後端，讀到的內容寫回前面的快取；不存在時回傳 None。"""
+    key = _cache_key(gcs_path, generation)
+    data = memory_cache.get(key)
+    if data is not None:
+        return data
+    if disk_cache is not None:
+        data = disk_cache.get(key)
+        if data is not None:
+            memory_cache.put(key, data)
+            return data
+    # 指定 generation 下載：物件在讀取 metadata 後被覆寫時回傳 None，新內容不會被存到舊 generation 的快取中
+    data = backend.get(gcs_path, None if generation == _IMMUTABLE_GENERATION else generation)
+    with _backend_stats_lock:
+        _backend_stats["hits" if data is not None else "misses"] += 1
+    if data is None:
+        return None
+    memory_cache.put(key, data)
+    if disk_cache is not None:
+        try:
+            disk_cache.put(key, data)
+        except OSError as e:
+            logger.warning(f"寫入磁碟快取失敗 ({gcs_path}): {e}")
+    return data
+
+def _stat_and_read(gcs_path, cached_generation=None):
+    """
+    讀取物件目前的 metadata 與內容，回傳 (stat, data)；不存在時回傳 (None, None)。
+    generation 等於 cached_generation 時不下載，data 為 None。
+    下載以 stat 的 generation 為條件，期間物件被覆寫時重新讀取 metadata。
+    """
+    for _ in range(_READ_ATTEMPTS):
+        stat = backend.stat(gcs_path)
+        if stat is None or stat["generation"] == cached_generation:
+            return stat, None
+        data = _read_through(gcs_path, stat["generation"])
+        if data is not None:
+            return stat, data
+    raise RuntimeError(f"物件在讀取期間持續被覆寫: {backend.uri(gcs_path)}")
+
+def read_object(gcs_path, immutable=False):
+    """
+    經由快取鏈讀取物件，回傳 bytes；不存在時回傳 None。
+
+    immutable=True 表示物件名稱固定對應同一份內容 (以內容雜湊命名的座位圖)，快取命中時不需任何網路請求；
+    其他物件先讀取 metadata，以 generation 確認快取內容仍是最新版本。
+    """
+    if immutable:
+        return _read_through(gcs_path, _IMMUTABLE_GENERATION)
+    _, data = _stat_and_read(gcs_path)
+    return data
+
+def _invalidate_immutable(gcs_path):
+    memory_cache.pop(_cache_key(gcs_path, _IMMUTABLE_GENERATION))
+    if disk_cache is not None:
+        disk_cache.pop(_cache_key(gcs_path, _IMMUTABLE_GENERATION))
+
+def storage_cache_stats():
+    """各層快取的命中統計；backend 為實際下載的次數。"""
+    with _backend_stats_lock:
+        backend_stats = dict(_backend_stats)
+    return {
+        "memory": memory_cache.stats(),
+        "disk": disk_cache.stats() if disk_cache is not None else None,
+        "backend": backend_stats,
+    }
+
+def download_from_gcs(gcs_path, save_local=False, immutable=False):
+    save_local = _backup_enabled(save_local)
     try:
-        blob = bucket.blob(gcs_path)
-        if blob.exists():
-            image_io = io.BytesIO()
-            blob.download_to_file(image_io)
-            image_io.seek(0)
+        data = read_object(gcs_path, immutable=immutable)
+        if data is not None:
+            image_io = io.BytesIO(data)
 
             if save_local:
                 local_path = os.path.join("local_backup", os.path.basename(gcs_path))
@@ -65,16 +189,143 @@ def download_from_gcs(gcs_path, save_local=False):
 
             return image_io
         else:
-            logger.info(f"GCS 檔案不存在: gs://{bucket.name}/{gcs_path}")
+            logger.info(f"GCS 檔案不存在: {backend.uri(gcs_path)}")
             return None
     except Exception as e:
         logger.error(f"從 GCS 下載檔案失敗 ({gcs_path}): {e}", exc_info=True)
         return None
 
+def _list_object_names(prefix):
+    return backend.list(prefix)
+
+def load_existence_index(prefix):
+    """列出 prefix 下所有物件建立存在索引，之後命中索引的查詢不再發出網路請求。"""
+    global _existing_objects, _existence_prefix
+    names = _list_object_names(prefix)
+    with _existence_lock:
+        _existing_objects = names
+        _existence_prefix = prefix
+    logger.info(f"存在索引載入完成: {backend.uri(prefix)} 共 {len(names)} 個物件。")
+
+def reconcile_existence_index():
+    """重新列出物件並與索引合併，保留列出期間才上傳的物件。"""
+    global _existing_objects
+    if _existing_objects is None:
+        return
+    with _existence_lock:
+        before = set(_existing_objects)
+    listed = _list_object_names(_existence_prefix)
+    with _existence_lock:
+        added_meanwhile = _existing_objects - before
+        _existing_objects = listed | added_meanwhile
+    logger.info(f"存在索引對帳完成: {len(_existing_objects)} 個物件。")
+
+def _reconcile_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            reconcile_existence_index()
+        except Exception as e:
+            logger.error(f"存在索引對帳失敗: {e}", exc_info=True)
+
+def start_existence_reconciler(interval=None):
+    """啟動背景對帳執行緒 (每個程序一個)。"""
+    global _reconciler_thread
+    if _reconciler_thread is not None:
+        return
+    interval = interval or EXISTENCE_RECONCILE_SECONDS
+    _reconciler_thread = threading.Thread(target=_reconcile_loop, args=(interval,), name="existence-reconciler", daemon=True)
+    _reconciler_thread.start()
+
+def mark_object_exists(gcs_path):
+    with _existence_lock:
+        if _existing_objects is not None and gcs_path.startswith(_existence_prefix):
+            _existing_objects.add(gcs_path)
+
+def mark_object_deleted(gcs_path):
+    with _existence_lock:
+        if _existing_objects is not None:
+            _existing_objects.discard(gcs_path)
+
 def check_image_exists_gcs(gcs_path):
+    # 索引命中時不需任何網路請求；未命中時仍向 GCS 確認 (可能是其他程序剛上傳的)
+    if _existing_objects is not None and gcs_path.startswith(_existence_prefix):
+        if gcs_path in _existing_objects:
+            return True
     try:
-        blob = bucket.blob(gcs_path)
-        return blob.exists()
+        exists = backend.exists(gcs_path)
+        if exists:
+            mark_object_exists(gcs_path)
+        return exists
     except Exception as e:
-        logger.error(f"檢查 GCS 圖片存在性失敗 (gs://{bucket.name}/{gcs_path}): {e}", exc_info=True)
+        logger.error(f"檢查 GCS 圖片存在性失敗 ({backend.uri(gcs_path)}): {e}", exc_info=True)
         return False
+
+def delete_from_gcs(gcs_path):
+    """刪除物件；物件不存在也視為成功。"""
+    try:
+        _invalidate_immutable(gcs_path)
+        if backend.delete(gcs_path):
+            logger.info(f"已刪除 GCS 物件: {backend.uri(gcs_path)}")
+        mark_object_deleted(gcs_path)
+        return True
+    except Exception as e:
+        logger.error(f"刪除 GCS 物件失敗 ({gcs_path}): {e}", exc_info=True)
+        return False
+
+def _save_local_backup(gcs_path, data):
+    local_path = os.path.join("local_backup", os.path.basename(gcs_path))
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    with open(local_path, 'wb') as f:
+        f.write(data)
+    logger.info(f"從 GCS 下載並備份至本機：{local_path}")
+
+def get_cached_asset(gcs_path, max_age=None, force_reload=False, save_local=False):
+    """
+    取得靜態素材的快取內容。
+
+    回傳 dict，包含 "data" (bytes，檔案不存在時為 None) 與 "generation"/"etag"。
+    快取在 max_age 秒內直接回傳 (不發出任何網路請求)；過期後只讀取 blob metadata，
+    generation 未改變時沿用記憶體中的內容，改變時才重新下載。
+    """
+    if max_age is None:
+        max_age = ASSET_REVALIDATE_SECONDS
+    entry = _asset_cache.get(gcs_path)
+    if entry and not force_reload and time.monotonic() - entry["checked_at"] < max_age:
+        return entry
+
+    with _asset_cache_lock:
+        entry = _asset_cache.get(gcs_path)
+        if entry and not force_reload and time.monotonic() - entry["checked_at"] < max_age:
+            return entry
+        try:
+            # generation 未改變時 data 為 None；改變時重新啟動後可由磁碟快取取得
+            cached_generation = entry["generation"] if entry and entry["data"] is not None else None
+            stat, data = _stat_and_read(gcs_path, cached_generation)
+            if stat is None:
+                if entry is None or entry["data"] is not None:
+                    logger.info(f"GCS 素材不存在: {backend.uri(gcs_path)}")
+                new_entry = {"data": None, "generation": None, "etag": None}
+            elif data is None:
+                new_entry = dict(entry)
+            else:
+                logger.info(f"已載入素材 {backend.uri(gcs_path)} (generation={stat['generation']}, {len(data)} bytes)")
+                if _backup_enabled(save_local):
+                    _save_local_backup(gcs_path, data)
+                new_entry = {"data": data, "generation": stat["generation"], "etag": stat["etag"]}
+        except Exception as e:
+            logger.error(f"重新驗證 GCS 素材失敗 ({gcs_path}): {e}", exc_info=True)
+            if entry is None:
+                return {"data": None, "generation": None, "etag": None, "checked_at": 0}
+            new_entry = dict(entry)  # 暫時沿用舊內容，等下一次到期再重試
+        new_entry["checked_at"] = time.monotonic()
+        _asset_cache[gcs_path] = new_entry
+        return new_entry
+
+def reload_assets(gcs_paths=None):
+    """讓指定 (預設為全部) 素材在下一次讀取時立即重新驗證。"""
+    with _asset_cache_lock:
+        for gcs_path in (gcs_paths if gcs_paths is not None else list(_asset_cache)):
+            if gcs_path in _asset_cache:
+                _asset_cache[gcs_path] = dict(_asset_cache[gcs_path], checked_at=0)
+    logger.info(f"已標記素材重新驗證: {gcs_paths if gcs_paths is not None else '全部'}")
@@ -0,0 +1,141 @@
+import re
+import unicodedata
+from pypinyin import lazy_pinyin, Style
+
+# 賓客查詢索引：名單載入時建立一次，之後每則訊息的查詢都是字典讀取。
+# 每份名單 (每場婚禮) 各自建立一個 GuestIndex。
+
+FUZZY_MAX_RESULTS = 5
+
+def name_bigrams(name_key):
+    """頭尾加上邊界符號的雙字組，讓三字姓名打錯中間一字時仍保有共同字組。"""
+    padded = f"\x02{name_key}\x03"
+    return {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+def bounded_edit_distance(a, b, max_distance):
+    """Levenshtein 距離；超過 max_distance 時提早結束並回傳 max_distance + 1。"""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous_row = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current_row = [i]
+        for j, char_b in enumerate(b, 1):
+            current_row.append(min(previous_row[j] + 1, current_row[j - 1] + 1, previous_row[j - 1] + (char_a != char_b)))
+        if min(current_row) > max_distance:
+            return max_distance + 1
+        previous_row = current_row
+    return previous_row[-1]
+
+def default_max_distance(name_key):
+    # 中文姓名多為 2~4 字，只容許一個字的差異；較長的 (如英文姓名) 容許兩個
+    return 1 if len(name_key) <= 4 else 2
+
+def normalize_romanization(text):
+    """羅馬拼音查詢鍵：只保留英文字母並轉小寫，'Chen Yan-yan' -> 'chenyanyan'。"""
+    return re.sub(r'[^a-z]', '', unicodedata.normalize("NFKC", str(text or "")).lower())
+
+def romanization_keys(name):
+    """
+    姓名的拼音查詢鍵 (不含聲調)：完整拼音、姓氏置後的完整拼音 (外國賓客常見寫法)
+    以及各字首字母，例如 陳彥彥 -> chenyanyan, yanyanchen, cyy。
+    """
+    syllables = [normalize_romanization(s) for s in lazy_pinyin(str(name), style=Style.NORMAL, errors='default')]
+    syllables = [s for s in syllables if s]
+    if not syllables:
+        return set()
+    keys = {"".join(syllables), "".join(s[0] for s in syllables)}
+    if len(syllables) > 1:
+        keys.add("".join(syllables[1:] + syllables[:1]))
+    # pypinyin 以 v 表示 ü (如 呂 -> lv)，一併接受 u 的寫法
+    keys |= {key.replace("v", "u") for key in keys if "v" in key}
+    return keys
+
+def normalize_name(text):
+    """NFKC 正規化 (全形轉半形)、忽略大小寫，並合併多餘空白。"""
+    if text is None:
+        return ""
+    normalized = unicodedata.normalize("NFKC", str(text)).casefold()
+    return " ".join(normalized.split())
+
+class GuestIndex:
+    def __init__(self, guests):
+        self.guests = list(guests)
+        self._by_name = {}           # 正規化姓名 -> [賓客, ...] (保持名單順序)
+        self._by_name_category = {}  # (正規化姓名, 正規化分類) -> 賓客
+        self._bigram_index = {}      # 雙字組 -> {正規化姓名, ...}，供模糊查詢
+        self._by_romanization = {}   # 拼音查詢鍵 -> [正規化姓名, ...]，供羅馬拼音查詢
+        self._image_paths = {}       # (原始姓名, 原始分類) -> 圖片 GCS 路徑，由 precompute_image_paths 填入
+        for guest in self.guests:
+            name_key = normalize_name(guest.get("name"))
+            if not name_key:
+                continue
+            if name_key not in self._by_name:
+                for bigram in name_bigrams(name_key):
+                    self._bigram_index.setdefault(bigram, set()).add(name_key)
+                for romanization_key in romanization_keys(name_key):
+                    self._by_romanization.setdefault(romanization_key, []).append(name_key)
+            self._by_name.setdefault(name_key, []).append(guest)
+            # 名單中重複的 (姓名, 分類) 以第一筆為準，與原本逐筆比對的結果相同
+            self._by_name_category.setdefault((name_key, normalize_name(guest.get("category"))), guest)
+
+    def __len__(self):
+        return len(self.guests)
+
+    @staticmethod
+    def _image_path_key(name, category):
+        category_str = str(category).strip() if category and str(category).strip() else ""
+        return (str(name), category_str)
+
+    def precompute_image_paths(self, path_for):
+        """為每位賓客計算一次圖片路徑 (path_for(姓名, 分類))，之後的查詢只需讀取字典。"""
+        self._image_paths = {
+            self._image_path_key(guest.get("name"), guest.get("category")): path_for(guest.get("name"), guest.get("category"))
+            for guest in self.guests if guest.get("name")
+        }
+
+    def image_path_for(self, name, category):
+        return self._image_paths.get(self._image_path_key(name, category))
+
+    def find_by_name(self, name_query):
+        return list(self._by_name.get(normalize_name(name_query), ()))
+
+    def find_by_name_and_category(self, name_query, category_query):
+        return self._by_name_category.get((normalize_name(name_query), normalize_name(category_query)))
+
+    def find_by_romanization(self, query):
+        """以不含聲調的拼音或字首查詢，如 'chen yanyan'、'cyy'。"""
+        query_key = normalize_romanization(query)
+        if len(query_key) < 2:
+            return []
+        return [guest for name_key in self._by_romanization.get(query_key, ()) for guest in self._by_name[name_key]]
+
+    def fuzzy_search(self, name_query, max_distance=None, limit=FUZZY_MAX_RESULTS):
+        """
+        容錯查詢：以雙字組倒排索引找出候選姓名，再以編輯距離過濾與排序。
+
+        回傳編輯距離在 max_distance 以內的賓客 (距離小、共同字組多者優先)，
+        最多 limit 個姓名；完全相符的姓名不在此列 (由 find_by_name 處理)。
+        """
+        query_key = normalize_name(name_query)
+        if not query_key:
+            return []
+        if max_distance is None:
+            max_distance = default_max_distance(query_key)
+
+        query_bigrams = name_bigrams(query_key)
+        shared_counts = {}
+        for bigram in query_bigrams:
+            for name_key in self._bigram_index.get(bigram, ()):
+                shared_counts[name_key] = shared_counts.get(name_key, 0) + 1
+
+        # 每一次編輯最多破壞兩個雙字組，共同字組太少的姓名不可能在距離內
+        min_shared = len(query_bigrams) - 2 * max_distance
+        ranked = []
+        for name_key, shared in shared_counts.items():
+            if name_key == query_key or shared < min_shared:
+                continue
+            distance = bounded_edit_distance(query_key, name_key, max_distance)
+            if distance <= max_distance:
+                ranked.append((distance, -shared, name_key))
+        ranked.sort()
+        return [guest for _, _, name_key in ranked[:limit] for guest in self._by_name[name_key]]
@@ -6,9 +6,15 @@ import re
 import hashlib
 import PIL
 import gcs_function
+import instrumentation
+import storage_backend
+from guest_index import GuestIndex
 import time
-from collections import Counter
-from PIL import Image, ImageDraw, ImageFont
+import threading
+from array import array
+from collections import Counter, namedtuple
+from types import MappingProxyType
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 from google.cloud import storage
 from pypinyin import pinyin, Style
 # --- 配置 (從環境變數讀取) ---
@@ -41,11 +47,26 @@ TABLE_RADIUS_PX = int(IMG_SCALE * 0.45)
 HIGHLIGHT_THICKNESS_PX = 6
 MIN_CANVAS_WIDTH = 480
 MIN_CANVAS_HEIGHT = 320
+PREVIEW_MAX_SIZE_PX = 240   # LINE 聊天室預覽圖的最長邊
+PREVIEW_JPEG_QUALITY = 80
+# PNG 輸出：rgba 為完整 32 位元；palette 為調色盤 ("P" 模式)；auto 在沒有背景照片時使用調色盤
+PNG_OUTPUT_MODE = os.environ.get('PNG_OUTPUT_MODE', 'auto')
+PNG_PALETTE_COLORS = int(os.environ.get('PNG_PALETTE_COLORS', 64))
+PNG_COMPRESS_LEVEL = int(os.environ.get('PNG_COMPRESS_LEVEL', 6))  # 0 (最快) ~ 9 (最小)
+# 預設 layered：以 benchmark.py 量測 (每個座位先暖機)，sprite 的繪製時間並未比 layered 少
+RENDER_MODE = os.environ.get('SEAT_RENDER_MODE', 'layered')  # full / layered / sprite
+# guest: 每位賓客一張圖 (圖上含姓名)；seat: 每個座位一張共用圖，問候語另以文字訊息發送
+IMAGE_SHARING_MODE = os.environ.get('IMAGE_SHARING_MODE', 'guest')
+# Bot 與 pre.py 共用的背景對齊方式，兩邊產生的圖片才會對應到同一個物件名稱
+BACKGROUND_ALIGNMENT = os.environ.get('BACKGROUND_ALIGNMENT', '延展')
+# 繪圖程式的輸出有任何改變時遞增，所有圖片的物件名稱隨之改變
+RENDERER_VERSION = "1"
 
 # --- 初始化 ---
 customer_list = []
 table_locations = {}
 customer_name_counts = Counter()
+guest_index = GuestIndex([])
 gcs_client = None
 bucket = None
 IS_LOCAL = False  # 預設為雲端執行
@@ -54,12 +75,8 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 
 # --- 初始化函式 ---
-def initialize_dependencies(gcs_service_account_path=None, data_dir=None):
-    global customer_list, table_locations, customer_name_counts, gcs_client, bucket, customer_list_path
-    # 1. 載入資料檔案
-    if not data_dir:
-        data_dir = os.path.dirname(__file__) # 預設資料檔與此模組在同一目錄
-    # 2. 初始化 GCS Client
+def _init_gcs_client(gcs_service_account_path, data_dir):
+    global gcs_client, bucket, IS_LOCAL
     try:
         if gcs_service_account_path:
             gcs_client = storage.Client.from_service_account_json(os.path.join(data_dir, gcs_service_account_path))
@@ -77,6 +94,17 @@ def initialize_dependencies(gcs_service_account_path=None, data_dir=None):
         logger.critical(f"連接 GCS 失敗: {e}", exc_info=True)
         raise
 
+def initialize_dependencies(gcs_service_account_path=None, data_dir=None):
+    global customer_list, table_locations, table_locations_version, layout_geometry, customer_name_counts, customer_list_path
+    # 1. 載入資料檔案
+    if not data_dir:
+        data_dir = os.path.dirname(__file__) # 預設資料檔與此模組在同一目錄
+    # 2. 初始化儲存後端 (非 GCS 後端不需要憑證，也不建立 GCS Client)
+    if storage_backend.STORAGE_BACKEND.lower() != "gcs":
+        gcs_function.init_storage(storage_backend.create_backend(data_dir=data_dir))
+    else:
+        _init_gcs_client(gcs_service_account_path, data_dir)
+
     # 載入賓客名單
     customer_list_path = os.path.join(data_dir, customer_list_path)
     if os.path.exists(customer_list_path):
@@ -92,11 +120,14 @@ def initialize_dependencies(gcs_service_account_path=None, data_dir=None):
         except Exception as e:
             logger.error(f"載入失敗 使用預設的範例賓客名單。", exc_info=True)
             customer_list = [{"name": "王小明", "category": "VIP", "seat": "T1"}]
-            customer_name_counts = 1
+            customer_name_counts = Counter(["王小明"])
     else:
         logger.warning(f"賓客名單未找到。")
         customer_list = []
         customer_name_counts = Counter()
+
+    # 建立賓客查詢索引 (含每位賓客的圖片路徑)
+    rebuild_guest_index()
     
     # 載入座位表
     table_locations_path = os.path.join(data_dir, table_location_file)
@@ -111,6 +142,20 @@ def initialize_dependencies(gcs_service_account_path=None, data_dir=None):
     else:
         logger.error(f"桌位資料未找到。")
         table_locations = {}
+    table_locations_version = compute_table_locations_version(table_locations)
+    layout_geometry = compile_layout_geometry(table_locations, table_locations_version)
+    invalidate_render_cache()
+
+    # 預先載入字型，之後所有繪圖共用
+    preload_fonts()
+
+def rebuild_guest_index():
+    """依目前的 customer_list / customer_name_counts 重建查詢索引；兩者變動後必須呼叫。"""
+    global guest_index
+    new_index = GuestIndex(customer_list)
+    new_index.precompute_image_paths(compute_gcs_image_path_for_customer)
+    guest_index = new_index
+    logger.info(f"賓客查詢索引建立完成: {len(guest_index)} 位賓客。")
 
 # --- 檔名生成邏輯 ---
 def generate_gcs_safe_ascii_element(text_element):
@@ -130,6 +175,13 @@ def generate_gcs_safe_ascii_element(text_element):
         return hashlib.md5(original_input_str.encode('utf-8')).hexdigest()[:10]
 
 def get_gcs_image_path_for_customer(customer_name_original, customer_category_original):
+    """賓客圖片的 GCS 路徑；名單中的賓客直接讀取索引中預先算好的結果。"""
+    image_path = guest_index.image_path_for(customer_name_original, customer_category_original)
+    if image_path is not None:
+        return image_path
+    return compute_gcs_image_path_for_customer(customer_name_original, customer_category_original)
+
+def compute_gcs_image_path_for_customer(customer_name_original, customer_category_original):
     global customer_name_counts
     customer_name_str = str(customer_name_original)
     customer_category_str = str(customer_category_original if customer_category_original and str(customer_category_original).strip() else "_NO_CATEGORY_")
@@ -150,30 +202,120 @@ def get_gcs_image_path_for_customer(customer_name_original, customer_category_or
     image_filename_on_gcs = f"{final_gcs_filename_base}.png"
     return f"{GCS_IMAGE_DIR}/{image_filename_on_gcs}"
 
-# --- 圖片生成邏輯 ---
-def create_seat_image(target_seat_id, customer_name, background_alignment="左上角"):
-    global table_locations
+def get_gcs_image_path_for_seat(seat_id):
+    """座位共用圖的 GCS 路徑，同一座位的所有賓客共用同一張圖。"""
+    seat_id_str = str(seat_id)
+    if seat_id_str.isascii():
+        # 一般座位 ID (如 T1) 直接使用；pypinyin 會把非中文字元轉成十六進位碼
+        readable_filename_prefix = re.sub(r'[^\w.-]+', '_', seat_id_str.lower()).strip('_')
+    else:
+        readable_filename_prefix = generate_gcs_safe_ascii_element(seat_id_str)
+    readable_filename_prefix = readable_filename_prefix or "seat"
+    unique_hash_suffix = hashlib.md5(f"seat::{seat_id_str}".encode('utf-8')).hexdigest()[:6]
+    return f"{GCS_IMAGE_DIR}/seats/{readable_filename_prefix}_{unique_hash_suffix}.png"
+
+def image_content_hash(target_seat_id, name_on_image, background_alignment=None):
+    """所有會影響圖片內容的輸入 (姓名、座位、佈局、素材、繪圖程式與輸出設定) 的雜湊。"""
+    content_inputs = [
+        RENDERER_VERSION, str(target_seat_id), name_on_image,
+        table_locations_version, current_asset_version(), background_alignment or BACKGROUND_ALIGNMENT,
+        resolve_png_output_mode(), PNG_PALETTE_COLORS, PNG_COMPRESS_LEVEL, PREVIEW_MAX_SIZE_PX, PREVIEW_JPEG_QUALITY,
+    ]
+    serialized = json.dumps(content_inputs, ensure_ascii=False, default=str)
+    return hashlib.md5(serialized.encode('utf-8')).hexdigest()[:12]
+
+def get_versioned_image_path(base_gcs_path, target_seat_id, name_on_image, background_alignment=None):
     """
-    產生包含座位、Logo 和可選背景圖的圖片。
-
-    Args:
-        target_seat_id (str):目標座位 ID。
-        customer_name (str):顧客姓名。
-        background_alignment (str): 背景圖片對齊方式。可選值：
-                                    "左上角", "右上角", "左下角", "右下角",
-                                    "置中", 
-                                    "上方置中", "下方置中", "左側置中", "右側置中",
-                                    "延展"。
-                                    預設為 "右下角"。
+    在可讀的基本路徑 (已預先算好) 後加上內容雜湊，如 generated_seat_maps/chenyanyan_b8b353_<雜湊>.png。
+    內容改變時物件名稱跟著改變，因此同一網址的內容永遠不變，可以長期快取。
     """
-    if not table_locations:
-        logger.error("table_locations 未載入或為空，無法產生座位圖。")
-        return None
+    return versioned_image_path_for_hash(base_gcs_path, image_content_hash(target_seat_id, name_on_image, background_alignment))
 
+def versioned_image_path_for_hash(base_gcs_path, content_hash):
+    """以已算好的內容雜湊組成物件名稱 (如繪圖子程序回傳的實際雜湊)。"""
+    base, ext = os.path.splitext(base_gcs_path)
+    return f"{base}_{content_hash}{ext}"
+
+def get_preview_gcs_path(image_gcs_path):
+    """原圖路徑對應的 LINE 預覽圖路徑。"""
+    base, _ = os.path.splitext(image_gcs_path)
+    return f"{base}_preview.jpg"
+
+def is_seat_sharing_mode():
+    return IMAGE_SHARING_MODE == "seat"
+
+# --- 圖片生成邏輯 ---
+COLOR_MAP = {
+    "normal":     "#cba6c3",
+    "stage":      "#9b8281",
+    "head_table": "#e7ded9",
+    "blocked":    "#fffcf7"
+}
+HIGHLIGHT_COLOR = "#ffdd30"       # 高亮顏色
+HIGHLIGHT_TEXT_COLOR = "#000000"
+TEXT_COLOR_ON_TABLE = "#ffffff"   # 桌子上文字的顏色
+TEXT_COLOR_ON_TABLE_DISPLAYNAME = "#ffffff" #備用紅色 "#ac4d4d"   # 桌子上文字的顏色
+TEXT_COLOR_PROMPT = "#000000"     # 底部提示文字的顏色
+
+# --- 底圖快取 ---
+# 場地底圖 (背景、LOGO、所有未高亮的桌位) 只與佈局、素材與對齊方式有關，與賓客無關，
+# 因此每個版本只繪製一次，之後每次請求複製底圖並只畫高亮桌位與提示文字。
+table_locations_version = None
+_base_layer_cache = {}
+_sprite_cache = {}
+_base_layer_lock = threading.Lock()
+
+def compute_table_locations_version(locations):
+    """以桌位資料內容計算版本字串，內容不變則版本不變。"""
+    serialized = json.dumps(locations, sort_keys=True, ensure_ascii=False)
+    return hashlib.md5(serialized.encode('utf-8')).hexdigest()[:12]
+
+def invalidate_render_cache():
+    """清除已繪製的底圖、高亮小圖與解碼後的素材，下次請求時會重新建立。"""
+    with _base_layer_lock:
+        _base_layer_cache.clear()
+        _sprite_cache.clear()
+    with _prepared_asset_lock:
+        _prepared_asset_cache.clear()
+    logger.info("已清除底圖快取。")
+
+def _get_asset(gcs_path):
+    with instrumentation.phase("assets"):
+        return gcs_function.get_cached_asset(gcs_path, save_local=not IS_LOCAL)
+
+def current_asset_version():
+    """背景圖與 LOGO 的 GCS generation；素材在 GCS 上更新後版本隨之改變。"""
+    return (_get_asset(BACKGROUND_IMAGE_GCS_PATH)["generation"], _get_asset(LOGO_IMAGE_GCS_PATH)["generation"])
+
+def reload_assets():
+    """背景圖或 LOGO 更新後呼叫，立即重新驗證素材，底圖會在版本改變時重新繪製。"""
+    gcs_function.reload_assets([BACKGROUND_IMAGE_GCS_PATH, LOGO_IMAGE_GCS_PATH])
+
+# --- 佈局幾何 ---
+# 桌位座標在載入時編譯成不可變的幾何資料，繪圖時只讀取，不再逐次重算畫布尺寸與各桌位置。
+GroupGeometry = namedtuple("GroupGeometry", ["item_type", "label", "bbox", "center", "member_ids"])
+LayoutGeometry = namedtuple("LayoutGeometry", [
+    "version",
+    "canvas_width_px",
+    "canvas_height_px",
+    "grid_content_height_px",
+    "grid_drawing_origin_y_pillow",
+    "groups",         # item_type -> GroupGeometry (舞台、主桌)
+    "table_ids",      # 其他桌位的 ID，順序與下列陣列一致
+    "table_types",
+    "table_labels",
+    "table_centers",  # array('d')：x0, y0, x1, y1, ...
+    "table_bboxes",   # array('d')：每桌 4 個值 (左, 上, 右, 下)
+    "seat_index",     # seat_id -> ("group", item_type) 或 ("table", 陣列索引)
+])
+layout_geometry = None
+
+def compile_layout_geometry(locations, version=None):
+    """將 table_locations 編譯成 LayoutGeometry。"""
     max_x_coord, max_y_coord = 0, 0
-    if table_locations:
-        all_x = [info["position"][0] for info in table_locations.values() if info and isinstance(info.get("position"), list) and len(info["position"]) > 0]
-        all_y = [info["position"][1] for info in table_locations.values() if info and isinstance(info.get("position"), list) and len(info["position"]) > 1]
+    if locations:
+        all_x = [info["position"][0] for info in locations.values() if info and isinstance(info.get("position"), list) and len(info["position"]) > 0]
+        all_y = [info["position"][1] for info in locations.values() if info and isinstance(info.get("position"), list) and len(info["position"]) > 1]
         if all_x: max_x_coord = max(all_x)
         if all_y: max_y_coord = max(all_y)
 
@@ -183,216 +325,502 @@ def create_seat_image(target_seat_id, customer_name, background_alignment="左
     canvas_height_px = LOGO_AREA_HEIGHT_PX + IMG_OFFSET_Y_TOP_GRID + grid_content_height_px + IMG_OFFSET_Y_BOTTOM + IMG_OFFSET_Y_TOP
     canvas_width_px = round(max(canvas_width_px, MIN_CANVAS_WIDTH))
     canvas_height_px = round(max(canvas_height_px, MIN_CANVAS_HEIGHT + LOGO_AREA_HEIGHT_PX))
+    grid_drawing_origin_y_pillow = IMG_OFFSET_Y_TOP + LOGO_AREA_HEIGHT_PX + IMG_OFFSET_Y_TOP_GRID
 
-    # 1. 建立基底畫布 (繪製底圖)
-    img = Image.new("RGBA", (int(canvas_width_px), int(canvas_height_px)), DEFAULT_IMAGE_BACKGROUND_COLOR)
-    logger.info(f"畫布尺寸計算完成：寬度 = {canvas_width_px}px, 高度 = {canvas_height_px}px")
+    # 將桌位按類型分組
+    stage_items = {k: v for k, v in locations.items() if v.get("type") == "stage"}
+    head_table_items = {k: v for k, v in locations.items() if v.get("type") == "head_table"}
+    other_items = {k: v for k, v in locations.items() if v.get("type") not in ["stage", "head_table"]}
 
-    # 2. 嘗試下載並根據指定的對齊方式貼上背景圖
-    background_img_io = gcs_function.download_from_gcs(BACKGROUND_IMAGE_GCS_PATH, save_local=not IS_LOCAL)
-    # background_img_io = gcs_function.force_download_from_gcs(BACKGROUND_IMAGE_GCS_PATH)
-    if background_img_io:
-        try:
-            logger.info(f"找到背景圖片 {BACKGROUND_IMAGE_GCS_PATH}，將根據 '{background_alignment}' 進行對齊。")
-            background_img = Image.open(background_img_io).convert("RGBA")
-            bg_width, bg_height = background_img.size
-            
-            # 使用 match-case 決定貼上座標
-            match background_alignment:
-                # 四個角落
-                case "左上角":
-                    paste_x, paste_y = 0, 0
-                case "右上角":
-                    paste_x, paste_y = canvas_width_px - bg_width, 0
-                case "左下角":
-                    paste_x, paste_y = 0, canvas_height_px - bg_height
-                case "右下角":
-                    paste_x, paste_y = canvas_width_px - bg_width, canvas_height_px - bg_height
-                
-                # 完全置中
-                case "置中":
-                    paste_x = (canvas_width_px - bg_width) // 2
-                    paste_y = (canvas_height_px - bg_height) // 2
-
-                # 新增的四個邊緣置中選項
-                case "上方置中":
-                    paste_x = (canvas_width_px - bg_width) // 2
-                    paste_y = 0
-                case "下方置中":
-                    paste_x = (canvas_width_px - bg_width) // 2
-                    paste_y = canvas_height_px - bg_height
-                case "左側置中":
-                    paste_x = 0
-                    paste_y = (canvas_height_px - bg_height) // 2
-                case "右側置中":
-                    paste_x = canvas_width_px - bg_width
-                    paste_y = (canvas_height_px - bg_height) // 2
-
-                # 延展
-                case "延展":
-                    logger.info(f"將背景圖延展以填滿整個畫布 ({canvas_width_px}x{canvas_height_px})。")
-                    resized_bg = background_img.resize((canvas_width_px, canvas_height_px), Image.Resampling.LANCZOS)
-                    img.paste(resized_bg, (0, 0), resized_bg if resized_bg.mode == 'RGBA' else None)
-                    paste_x, paste_y = None, None # 跳過後續的貼上
-                
-                # 預設/錯誤處理
-                case _:
-                    logger.warning(f"提供了無效的背景對齊參數。將使用預設的 '左上角' 對齊。")
-                    paste_x, paste_y = canvas_width_px - bg_width, canvas_height_px - bg_height
-
-            if paste_x is not None:
-                img.paste(background_img, (paste_x, paste_y), background_img)
+    groups = {}
+    seat_index = {}
+    for item_type, label, items in (("stage", "舞台", stage_items), ("head_table", "主桌", head_table_items)):
+        if not items: continue
+        coords_x = [v['position'][0] for v in items.values()]
+        coords_y = [v['position'][1] for v in items.values()]
+        min_gx, max_gx = min(coords_x), max(coords_x)
+        min_gy, max_gy = max(coords_y), min(coords_y)
 
-        except Exception as e:
-            logger.error(f"處理背景圖片失敗 ({BACKGROUND_IMAGE_GCS_PATH})，將使用預設背景色。")
-    else:
-        logger.info(f"未找到背景圖片 {BACKGROUND_IMAGE_GCS_PATH}，將使用預設背景色。")
+        x0 = IMG_OFFSET_X + min_gx * IMG_SCALE
+        x1 = IMG_OFFSET_X + (max_gx + 1) * IMG_SCALE
+        y0 = grid_drawing_origin_y_pillow + (grid_content_height_px - (min_gy + 1) * IMG_SCALE)
+        y1 = grid_drawing_origin_y_pillow + (grid_content_height_px - max_gy * IMG_SCALE)
+        groups[item_type] = GroupGeometry(item_type, label, (x0, y0, x1, y1), ((x0 + x1) / 2, (y0 + y1) / 2), tuple(items))
+        for item_id in items:
+            seat_index[item_id] = ("group", item_type)
 
-    # 3. 繪製 LOGO 圖 (維持在上方中央)
-    draw = ImageDraw.Draw(img)   
-    logo_img_io = gcs_function.download_from_gcs(LOGO_IMAGE_GCS_PATH, save_local=not IS_LOCAL)
-    if logo_img_io:
-        try:
-            logo_original = Image.open(logo_img_io).convert("RGBA")
-            logo_available_width = canvas_width_px - (IMG_OFFSET_X + LOGO_PADDING_PX) * 2
-            logo_available_height = LOGO_AREA_HEIGHT_PX - LOGO_PADDING_PX * 2
-            logo_scaled = logo_original.copy()
-            logo_scaled.thumbnail((logo_available_width, logo_available_height), Image.Resampling.LANCZOS)
-            logo_paste_x = (canvas_width_px - logo_scaled.width) // 2
-            logo_paste_y = IMG_OFFSET_Y_TOP + LOGO_PADDING_PX + (logo_available_height - logo_scaled.height) // 2
-            img.paste(logo_scaled, (logo_paste_x, logo_paste_y), logo_scaled)
-        except Exception as e:
-            logger.error(f"載入或繪製 LOGO 失敗 ({LOGO_IMAGE_GCS_PATH})")
+    table_ids, table_types, table_labels = [], [], []
+    table_centers, table_bboxes = array('d'), array('d')
+    radius = TABLE_RADIUS_PX
+    for item_id, info in other_items.items():
+        if not (info and isinstance(info.get("position"), list) and len(info["position"]) == 2): continue
+        grid_x, grid_y = info["position"]
+        center_x = IMG_OFFSET_X + grid_x * IMG_SCALE + IMG_SCALE // 2
+        center_y = grid_drawing_origin_y_pillow + (grid_content_height_px - (grid_y * IMG_SCALE + IMG_SCALE // 2))
+        label = f"{item_id}"
+        display_name = info.get("displayName", "")
+        if display_name:
+            label += f"\n{display_name}"
+        seat_index[item_id] = ("table", len(table_ids))
+        table_ids.append(item_id)
+        table_types.append(info.get("type", "normal"))
+        table_labels.append(label)
+        table_centers.extend((center_x, center_y))
+        table_bboxes.extend((center_x - radius, center_y - radius, center_x + radius, center_y + radius))
+
+    return LayoutGeometry(
+        version=version if version is not None else compute_table_locations_version(locations),
+        canvas_width_px=canvas_width_px,
+        canvas_height_px=canvas_height_px,
+        grid_content_height_px=grid_content_height_px,
+        grid_drawing_origin_y_pillow=grid_drawing_origin_y_pillow,
+        groups=MappingProxyType(groups),
+        table_ids=tuple(table_ids),
+        table_types=tuple(table_types),
+        table_labels=tuple(table_labels),
+        table_centers=table_centers,
+        table_bboxes=table_bboxes,
+        seat_index=MappingProxyType(seat_index),
+    )
+
+# --- 字型快取 ---
+# 字型檔 (CJK 字型動輒數 MB) 每個 (路徑, 字級) 在整個程序中只解析一次，由所有繪圖共用。
+FONT_SIZES = {"large": 28, "table_id": 14, "table_displayname": 12, "prompt_small": 18}
+_font_registry = {}
+_font_registry_lock = threading.Lock()
+_fonts = None
+
+def get_font(font_path, size):
+    """依 (字型路徑, 字級) 取得字型；font_path 為 None 時使用 Pillow 預設字型。"""
+    cache_key = (font_path, size)
+    font = _font_registry.get(cache_key)
+    if font is None:
+        with _font_registry_lock:
+            font = _font_registry.get(cache_key)
+            if font is None:
+                font = PIL.ImageFont.truetype(font_path, size) if font_path else PIL.ImageFont.load_default(size=size)
+                _font_registry[cache_key] = font
+    return font
+
+def preload_fonts():
+    """解析字型路徑並載入繪圖用到的所有字級，於 initialize_dependencies 時呼叫。"""
+    global _fonts
     font_path = os.path.join(os.path.dirname(__file__), DEFAULT_FONT_PATH)
     if not os.path.exists(font_path): 
         logger.warning(f"字型檔案 '{font_path}' 未找到，將使用預設字型。")
         font_path = None 
     try:
-        font_large = PIL.ImageFont.truetype(font_path, 28) if font_path else PIL.ImageFont.load_default(size=28)
-        font_table_id = PIL.ImageFont.truetype(font_path, 14) if font_path else PIL.ImageFont.load_default(size=14)
-        font_table_displayname = PIL.ImageFont.truetype(font_path, 12) if font_path else PIL.ImageFont.load_default(size=12)
-        font_prompt_small = PIL.ImageFont.truetype(font_path, 18) if font_path else PIL.ImageFont.load_default(size=18)
+        _fonts = {name: get_font(font_path, size) for name, size in FONT_SIZES.items()}
     except Exception as e:
         logger.critical(f"載入字型時發生嚴重錯誤", exc_info=True)
         raise
+    logger.info(f"字型載入完成: {font_path if font_path else '預設字型'} ({len(_fonts)} 種字級)。")
+    return _fonts
+
+def get_fonts():
+    return _fonts if _fonts is not None else preload_fonts()
+
+# 輔助函數 1：繪製多行文字
+def _draw_multiline_text(draw, center_pos, text, font, fill_color, fill_color_line2=None):
+    lines = text.split("\n")
+    center_x, center_y = center_pos
+    if len(lines) == 1:
+        draw.text((center_x, center_y), lines[0], fill=fill_color, font=font, anchor="mm", align="center")
+    elif len(lines) == 2:
+        line_spacing = 2
+        try:
+            # Pillow 10.x.x
+            _, top, _, bottom = font.getbbox("A")
+            h = bottom - top
+        except AttributeError:
+            # Older Pillow
+            w, h = font.getsize("A")
+        
+        line1_y = center_y - h / 2 - line_spacing
+        line2_y = center_y + h / 2 + line_spacing
+        second_line_color = fill_color_line2 if fill_color_line2 else fill_color
+        draw.text((center_x, line1_y), lines[0], fill=fill_color, font=font, anchor="mm")
+        draw.text((center_x, line2_y), lines[1], fill=second_line_color, font=font, anchor="mm")
+
+# 輔助函數 2：繪製群組形狀 (舞台、主桌)
+def _draw_group_box(draw, fonts, group, is_highlighted):
+    bbox = group.bbox
+    current_color = COLOR_MAP.get(group.item_type)
+    text_color = HIGHLIGHT_TEXT_COLOR if is_highlighted else TEXT_COLOR_ON_TABLE
+    
+    shape_draw_func = draw.ellipse if group.item_type == "head_table" else draw.rectangle
+    
+    if is_highlighted:
+        outer_bbox = (bbox[0] - HIGHLIGHT_THICKNESS_PX, bbox[1] - HIGHLIGHT_THICKNESS_PX, 
+                      bbox[2] + HIGHLIGHT_THICKNESS_PX, bbox[3] + HIGHLIGHT_THICKNESS_PX)
+        shape_draw_func(outer_bbox, fill=HIGHLIGHT_COLOR)
+
+    shape_draw_func(bbox, fill=current_color)
+    _draw_multiline_text(draw, group.center, group.label, fonts["prompt_small"], text_color)
+
+# 輔助函數 3：繪製單一桌位
+def _draw_table(draw, fonts, geometry, index, is_highlighted):
+    item_type = geometry.table_types[index]
+    center_x, center_y = geometry.table_centers[index * 2], geometry.table_centers[index * 2 + 1]
+    bbox = tuple(geometry.table_bboxes[index * 4:index * 4 + 4])
+    current_color = COLOR_MAP.get(item_type)
+    radius = TABLE_RADIUS_PX
+
+    if is_highlighted:
+        outer_bbox = (bbox[0] - HIGHLIGHT_THICKNESS_PX, bbox[1] - HIGHLIGHT_THICKNESS_PX, 
+                      bbox[2] + HIGHLIGHT_THICKNESS_PX, bbox[3] + HIGHLIGHT_THICKNESS_PX)
+        draw.ellipse(outer_bbox, fill=HIGHLIGHT_COLOR)
+
+    if item_type == "blocked":
+        draw.line([(bbox[0]+radius*0.3, bbox[1]+radius*0.3), (bbox[2]-radius*0.3, bbox[3]-radius*0.3)], fill=current_color, width=2)
+        draw.line([(bbox[0]+radius*0.3, bbox[3]-radius*0.3), (bbox[2]-radius*0.3, bbox[1]+radius*0.3)], fill=current_color, width=2)
+    else: # Normal tables
+        draw.ellipse(bbox, fill=current_color)
+        text_color = HIGHLIGHT_TEXT_COLOR if is_highlighted else TEXT_COLOR_ON_TABLE
+        text_color_dn = HIGHLIGHT_TEXT_COLOR if is_highlighted else TEXT_COLOR_ON_TABLE_DISPLAYNAME
+        _draw_multiline_text(draw, (center_x, center_y), geometry.table_labels[index], fonts["table_displayname"], text_color, text_color_dn)
+
+def _draw_highlight(draw, fonts, geometry, target_seat_id):
+    """在底圖上只重畫目標桌位 (或其所屬群組) 的高亮版本。"""
+    seat_entry = geometry.seat_index.get(target_seat_id)
+    if seat_entry is None:
+        return
+    kind, ref = seat_entry
+    if kind == "group":
+        _draw_group_box(draw, fonts, geometry.groups[ref], True)
+    else:
+        _draw_table(draw, fonts, geometry, ref, True)
 
-    color_map = {
-    "normal":     "#cba6c3",
-    "stage":      "#9b8281", 
-    "head_table": "#e7ded9",
-    "blocked":    "#fffcf7" 
-    }
-    highlight_color = "#ffdd30"       # 高亮顏色
-    highlight_text_color = "#000000"
-    text_color_on_table = "#ffffff"   # 桌子上文字的顏色
-    text_color_on_table_displayname = "#ffffff" #備用紅色 "#ac4d4d"   # 桌子上文字的顏色
-    text_color_prompt = "#000000"     # 底部提示文字的顏色
-
-    grid_drawing_origin_y_pillow = IMG_OFFSET_Y_TOP + LOGO_AREA_HEIGHT_PX + IMG_OFFSET_Y_TOP_GRID
-
-    # 輔助函數 1：繪製多行文字 (作為巢狀函式)
-    def draw_multiline_text(center_pos, text, font, fill_color, fill_color_line2=None):
-        lines = text.split("\n")
-        center_x, center_y = center_pos
-        if len(lines) == 1:
-            draw.text((center_x, center_y), lines[0], fill=fill_color, font=font, anchor="mm", align="center")
-        elif len(lines) == 2:
-            line_spacing = 2
-            try:
-                # Pillow 10.x.x
-                _, top, _, bottom = font.getbbox("A")
-                h = bottom - top
-            except AttributeError:
-                # Older Pillow
-                w, h = font.getsize("A")
-            
-            line1_y = center_y - h / 2 - line_spacing
-            line2_y = center_y + h / 2 + line_spacing
-            second_line_color = fill_color_line2 if fill_color_line2 else fill_color
-            draw.text((center_x, line1_y), lines[0], fill=fill_color, font=font, anchor="mm")
-            draw.text((center_x, line2_y), lines[1], fill=second_line_color, font=font, anchor="mm")
-
-    # 輔助函數 2：繪製群組形狀 (作為巢狀函式)
-    def draw_group_box(items, text, item_type):
-        if not items: return
-        coords_x = [v['position'][0] for v in items.values()]
-        coords_y = [v['position'][1] for v in items.values()]
-        min_gx, max_gx = min(coords_x), max(coords_x)
-        min_gy, max_gy = max(coords_y), min(coords_y)
-
-        x0 = IMG_OFFSET_X + min_gx * IMG_SCALE
-        x1 = IMG_OFFSET_X + (max_gx + 1) * IMG_SCALE
-        y0 = grid_drawing_origin_y_pillow + (grid_content_height_px - (min_gy + 1) * IMG_SCALE)
-        y1 = grid_drawing_origin_y_pillow + (grid_content_height_px - max_gy * IMG_SCALE)
-        bbox = (x0, y0, x1, y1)
-        center_x, center_y = (x0 + x1) / 2, (y0 + y1) / 2
+# --- 素材解碼快取 ---
+# 背景圖與 LOGO 解碼、縮放後的 RGBA 圖片與貼上座標，依 (素材版本, 畫布寬, 畫布高, 對齊方式) 快取，
+# 每種佈局只解碼、重新取樣一次。
+_prepared_asset_cache = {}
+_prepared_asset_lock = threading.Lock()
 
-        is_highlighted = any(item_id == target_seat_id for item_id in items)
-        current_color = color_map.get(item_type)
-        text_color = highlight_text_color if is_highlighted else text_color_on_table
+def _prepare_background(background_data, canvas_width_px, canvas_height_px, background_alignment):
+    background_img = Image.open(io.BytesIO(background_data)).convert("RGBA")
+    bg_width, bg_height = background_img.size
+    
+    # 使用 match-case 決定貼上座標
+    match background_alignment:
+        # 四個角落
+        case "左上角":
+            paste_x, paste_y = 0, 0
+        case "右上角":
+            paste_x, paste_y = canvas_width_px - bg_width, 0
+        case "左下角":
+            paste_x, paste_y = 0, canvas_height_px - bg_height
+        case "右下角":
+            paste_x, paste_y = canvas_width_px - bg_width, canvas_height_px - bg_height
         
-        shape_draw_func = draw.ellipse if item_type == "head_table" else draw.rectangle
+        # 完全置中
+        case "置中":
+            paste_x = (canvas_width_px - bg_width) // 2
+            paste_y = (canvas_height_px - bg_height) // 2
+
+        # 新增的四個邊緣置中選項
+        case "上方置中":
+            paste_x = (canvas_width_px - bg_width) // 2
+            paste_y = 0
+        case "下方置中":
+            paste_x = (canvas_width_px - bg_width) // 2
+            paste_y = canvas_height_px - bg_height
+        case "左側置中":
+            paste_x = 0
+            paste_y = (canvas_height_px - bg_height) // 2
+        case "右側置中":
+            paste_x = canvas_width_px - bg_width
+            paste_y = (canvas_height_px - bg_height) // 2
+
+        # 延展
+        case "延展":
+            logger.info(f"將背景圖延展以填滿整個畫布 ({canvas_width_px}x{canvas_height_px})。")
+            background_img = background_img.resize((canvas_width_px, canvas_height_px), Image.Resampling.LANCZOS)
+            paste_x, paste_y = 0, 0
         
-        if is_highlighted:
-            outer_bbox = (bbox[0] - HIGHLIGHT_THICKNESS_PX, bbox[1] - HIGHLIGHT_THICKNESS_PX, 
-                          bbox[2] + HIGHLIGHT_THICKNESS_PX, bbox[3] + HIGHLIGHT_THICKNESS_PX)
-            shape_draw_func(outer_bbox, fill=highlight_color)
+        # 預設/錯誤處理
+        case _:
+            logger.warning(f"提供了無效的背景對齊參數。將使用預設的 '左上角' 對齊。")
+            paste_x, paste_y = canvas_width_px - bg_width, canvas_height_px - bg_height
+
+    return background_img, (paste_x, paste_y)
+
+def _store_prepared_asset(cache_key, prepared):
+    # 同一素材的舊版本 (generation 不同) 已不會再使用，一併移除
+    for stale_key in [k for k in _prepared_asset_cache if k[0] == cache_key[0] and k[1] != cache_key[1]]:
+        del _prepared_asset_cache[stale_key]
+    _prepared_asset_cache[cache_key] = prepared
+
+def get_prepared_background(canvas_width_px, canvas_height_px, background_alignment):
+    """回傳 (可直接貼上的 RGBA 背景圖, 貼上座標)；沒有背景圖或處理失敗時回傳 None。"""
+    background_asset = _get_asset(BACKGROUND_IMAGE_GCS_PATH)
+    cache_key = ("background", background_asset["generation"], canvas_width_px, canvas_height_px, background_alignment)
+    if cache_key in _prepared_asset_cache:
+        return _prepared_asset_cache[cache_key]
+    with _prepared_asset_lock:
+        if cache_key in _prepared_asset_cache:
+            return _prepared_asset_cache[cache_key]
+        prepared = None
+        if background_asset["data"]:
+            try:
+                logger.info(f"找到背景圖片 {BACKGROUND_IMAGE_GCS_PATH}，將根據 '{background_alignment}' 進行對齊。")
+                prepared = _prepare_background(background_asset["data"], canvas_width_px, canvas_height_px, background_alignment)
+            except Exception as e:
+                logger.error(f"處理背景圖片失敗 ({BACKGROUND_IMAGE_GCS_PATH})，將使用預設背景色。")
+        else:
+            logger.info(f"未找到背景圖片 {BACKGROUND_IMAGE_GCS_PATH}，將使用預設背景色。")
+        _store_prepared_asset(cache_key, prepared)
+        return prepared
+
+def get_prepared_logo(canvas_width_px):
+    """回傳 (縮放後的 RGBA LOGO, 貼上座標)；沒有 LOGO 或處理失敗時回傳 None。"""
+    logo_asset = _get_asset(LOGO_IMAGE_GCS_PATH)
+    cache_key = ("logo", logo_asset["generation"], canvas_width_px)
+    if cache_key in _prepared_asset_cache:
+        return _prepared_asset_cache[cache_key]
+    with _prepared_asset_lock:
+        if cache_key in _prepared_asset_cache:
+            return _prepared_asset_cache[cache_key]
+        prepared = None
+        if logo_asset["data"]:
+            try:
+                logo_original = Image.open(io.BytesIO(logo_asset["data"])).convert("RGBA")
+                logo_available_width = canvas_width_px - (IMG_OFFSET_X + LOGO_PADDING_PX) * 2
+                logo_available_height = LOGO_AREA_HEIGHT_PX - LOGO_PADDING_PX * 2
+                logo_original.thumbnail((logo_available_width, logo_available_height), Image.Resampling.LANCZOS)
+                logo_paste_x = (canvas_width_px - logo_original.width) // 2
+                logo_paste_y = IMG_OFFSET_Y_TOP + LOGO_PADDING_PX + (logo_available_height - logo_original.height) // 2
+                prepared = (logo_original, (logo_paste_x, logo_paste_y))
+            except Exception as e:
+                logger.error(f"載入或繪製 LOGO 失敗 ({LOGO_IMAGE_GCS_PATH})")
+        _store_prepared_asset(cache_key, prepared)
+        return prepared
+
+def _paste_background(img, canvas_width_px, canvas_height_px, background_alignment):
+    prepared = get_prepared_background(canvas_width_px, canvas_height_px, background_alignment)
+    if prepared:
+        background_img, paste_position = prepared
+        img.paste(background_img, paste_position, background_img)
+
+def _paste_logo(img, canvas_width_px):
+    # 繪製 LOGO 圖 (維持在上方中央)
+    prepared = get_prepared_logo(canvas_width_px)
+    if prepared:
+        logo_scaled, paste_position = prepared
+        img.paste(logo_scaled, paste_position, logo_scaled)
+
+def _build_base_layer(background_alignment, fonts, geometry):
+    canvas_width_px = geometry.canvas_width_px
+    canvas_height_px = geometry.canvas_height_px
 
-        shape_draw_func(bbox, fill=current_color)
-        draw_multiline_text((center_x, center_y), text, font_prompt_small, text_color)
+    # 1. 建立基底畫布 (繪製底圖)
+    img = Image.new("RGBA", (int(canvas_width_px), int(canvas_height_px)), DEFAULT_IMAGE_BACKGROUND_COLOR)
+    logger.info(f"畫布尺寸計算完成：寬度 = {canvas_width_px}px, 高度 = {canvas_height_px}px")
 
-    # --- 開始：群組繪製邏輯 ---
-    
-    # 1. 將桌位按類型分組
-    stage_items = {k: v for k, v in table_locations.items() if v.get("type") == "stage"}
-    head_table_items = {k: v for k, v in table_locations.items() if v.get("type") == "head_table"}
-    other_items = {k: v for k, v in table_locations.items() if v.get("type") not in ["stage", "head_table"]}
+    # 2. 背景圖與 LOGO
+    _paste_background(img, canvas_width_px, canvas_height_px, background_alignment)
+    _paste_logo(img, canvas_width_px)
+
+    # 3. 繪製所有桌位 (皆不高亮)
+    draw = ImageDraw.Draw(img)
+    for group in geometry.groups.values():
+        _draw_group_box(draw, fonts, group, False)
+    for index in range(len(geometry.table_ids)):
+        _draw_table(draw, fonts, geometry, index, False)
+    return img
+
+def base_layer_key(geometry, background_alignment):
+    return (geometry.version, current_asset_version(), background_alignment)
+
+def get_base_layer(cache_key, fonts, geometry):
+    """取得 (佈局版本, 素材版本, 對齊方式) 對應的底圖，必要時才繪製。"""
+    base_layer = _base_layer_cache.get(cache_key)
+    if base_layer is not None:
+        return base_layer
+    with _base_layer_lock:
+        base_layer = _base_layer_cache.get(cache_key)
+        if base_layer is None:
+            layout_version, asset_version, background_alignment = cache_key
+            logger.info(f"建立底圖: 佈局版本='{layout_version}', 素材版本={asset_version}, 對齊='{background_alignment}'")
+            with instrumentation.phase("base_layer_build"):
+                base_layer = _build_base_layer(background_alignment, fonts, geometry)
+            # 佈局或素材版本已改變的舊底圖不會再被使用，一併移除
+            for stale_key in [k for k in _base_layer_cache if k[:2] != cache_key[:2]]:
+                del _base_layer_cache[stale_key]
+            for stale_key in [k for k in _sprite_cache if k[0][:2] != cache_key[:2]]:
+                del _sprite_cache[stale_key]
+            _base_layer_cache[cache_key] = base_layer
+    return base_layer
+
+def get_highlight_sprite(target_seat_id, base_key, fonts, geometry):
+    """
+    取得目標桌位的高亮小圖 (RGBA) 與其貼上座標。
 
-    # 2. 繪製群組（舞台和主桌）
-    stage_bbox = draw_group_box(stage_items, "舞台", "stage")
-    head_table_bbox = draw_group_box(head_table_items, "主桌", "head_table")
+    小圖由「底圖 + 高亮」與底圖的差異範圍裁切而來，因此貼回底圖後
+    與直接在整張畫布上繪製高亮的結果完全相同。座位不在佈局中時回傳 None。
+    """
+    # 舞台與主桌以整個群組高亮，群組內的座位共用同一張高亮小圖
+    seat_entry = geometry.seat_index.get(target_seat_id)
+    if seat_entry is None:
+        return None
+    cache_key = (base_key, seat_entry)
+    sprite = _sprite_cache.get(cache_key)
+    if sprite is not None:
+        return sprite
+    base_layer = get_base_layer(base_key, fonts, geometry)
+    with _base_layer_lock:
+        if cache_key not in _sprite_cache:
+            # 底圖的第一張小圖：一次建立所有桌位的小圖，之後的請求都不會再遇到建立小圖的成本
+            with instrumentation.phase("sprite_build"):
+                _build_all_sprites_locked(base_key, base_layer, fonts, geometry)
+        sprite = _sprite_cache.get(cache_key)
+    return sprite
+
+def _build_all_sprites_locked(base_key, base_layer, fonts, geometry):
+    # 需持有 _base_layer_lock；同一群組的座位共用一張小圖，每個 seat_entry 只建立一次
+    seats_by_entry = {}
+    for seat_id, seat_entry in geometry.seat_index.items():
+        seats_by_entry.setdefault(seat_entry, seat_id)
+    for seat_entry, seat_id in seats_by_entry.items():
+        if (base_key, seat_entry) in _sprite_cache:
+            continue
+        highlighted = base_layer.copy()
+        _draw_highlight(ImageDraw.Draw(highlighted), fonts, geometry, seat_id)
+        dirty_bbox = ImageChops.difference(highlighted, base_layer).getbbox()
+        if dirty_bbox is None:
+            sprite = (None, (0, 0))
+        else:
+            sprite = (highlighted.crop(dirty_bbox), dirty_bbox[:2])
+        _sprite_cache[(base_key, seat_entry)] = sprite
+    logger.info(f"已建立 {len(seats_by_entry)} 張高亮小圖。")
+
+def build_prompt(target_seat_id, customer_name=None):
+    """座位提示文字；customer_name 為 None 時 (座位共用圖) 省略問候。"""
+    greeting = f"{customer_name} 您好，" if customer_name else ""
+    prompt = f"{greeting}您的座位是 {target_seat_id}"
+    if target_seat_id not in table_locations: 
+        prompt = f"{greeting}座位 {target_seat_id} 未在佈局圖中找到。"
+    return prompt
+
+def _paste_prompt_strip(img, prompt, font, geometry):
+    # 只在提示文字實際佔用的範圍內繪製，其餘像素維持底圖
+    text_pos = (geometry.canvas_width_px / 2, geometry.canvas_height_px - IMG_OFFSET_Y_BOTTOM / 2)
+    left, top, right, bottom = ImageDraw.Draw(img).textbbox(text_pos, prompt, font=font, anchor="mm")
+    strip_box = (max(0, int(left) - 1), max(0, int(top) - 1),
+                 min(img.width, int(right) + 2), min(img.height, int(bottom) + 2))
+    if strip_box[0] >= strip_box[2] or strip_box[1] >= strip_box[3]:
+        return
+    strip = img.crop(strip_box)
+    ImageDraw.Draw(strip).text((text_pos[0] - strip_box[0], text_pos[1] - strip_box[1]), prompt, fill=TEXT_COLOR_PROMPT, font=font, anchor="mm")
+    img.paste(strip, strip_box[:2])
+
+def render_seat_canvas(target_seat_id, customer_name, background_alignment="左上角", render_mode=None):
+    global table_locations
+    """
+    產生包含座位、Logo 和可選背景圖的圖片 (PIL Image，尚未編碼)。
 
-    # 3. 繪製其他獨立項目
-    for item_id, info in other_items.items():
-        if not (info and isinstance(info.get("position"), list) and len(info["position"]) == 2): continue
-        
-        grid_x, grid_y = info["position"]
-        item_type = info.get("type", "normal")
-        center_x = IMG_OFFSET_X + grid_x * IMG_SCALE + IMG_SCALE // 2
-        center_y = grid_drawing_origin_y_pillow + (grid_content_height_px - (grid_y * IMG_SCALE + IMG_SCALE // 2))
-        
-        is_highlighted = (item_id == target_seat_id)
-        current_color = color_map.get(item_type)
-        radius = TABLE_RADIUS_PX
-        bbox = (center_x - radius, center_y - radius, center_x + radius, center_y + radius)
-
-        if is_highlighted:
-            outer_bbox = (bbox[0] - HIGHLIGHT_THICKNESS_PX, bbox[1] - HIGHLIGHT_THICKNESS_PX, 
-                          bbox[2] + HIGHLIGHT_THICKNESS_PX, bbox[3] + HIGHLIGHT_THICKNESS_PX)
-            draw.ellipse(outer_bbox, fill=highlight_color)
-
-        if item_type == "blocked":
-            draw.line([(bbox[0]+radius*0.3, bbox[1]+radius*0.3), (bbox[2]-radius*0.3, bbox[3]-radius*0.3)], fill=current_color, width=2)
-            draw.line([(bbox[0]+radius*0.3, bbox[3]-radius*0.3), (bbox[2]-radius*0.3, bbox[1]+radius*0.3)], fill=current_color, width=2)
-        else: # Normal tables
-            draw.ellipse(bbox, fill=current_color)
-            text_to_display = f"{item_id}"
-            display_name = info.get("displayName", "")
-            if display_name:
-                text_to_display += f"\n{display_name}"
-            
-            text_color = highlight_text_color if is_highlighted else text_color_on_table
-            text_color_dn = highlight_text_color if is_highlighted else text_color_on_table_displayname
-            draw_multiline_text((center_x, center_y), text_to_display, font_table_displayname, text_color, text_color_dn)
+    Args:
+        target_seat_id (str):目標座位 ID。
+        customer_name (str):顧客姓名。為 None 時產生不含姓名的座位共用圖。
+        background_alignment (str): 背景圖片對齊方式。可選值：
+                                    "左上角", "右上角", "左下角", "右下角",
+                                    "置中", 
+                                    "上方置中", "下方置中", "左側置中", "右側置中",
+                                    "延展"。
+                                    預設為 "右下角"。
+        render_mode (str): 繪製模式，預設為 RENDER_MODE。可選值：
+                           "full"    每次重新繪製整張場地圖。
+                           "layered" 複製快取底圖後，以 ImageDraw 畫高亮與提示文字。
+                           "sprite"  複製快取底圖後，只貼上高亮小圖與提示文字區塊。
+    """
+    if not table_locations or layout_geometry is None:
+        logger.error("table_locations 未載入或為空，無法產生座位圖。")
+        return None
 
-    # 4. 繪製底部提示文字
-    prompt = f"{customer_name} 您好，您的座位是 {target_seat_id}"
-    if target_seat_id not in table_locations: 
-        prompt = f"{customer_name} 您好，座位 {target_seat_id} 未在佈局圖中找到。"
-    draw.text((canvas_width_px / 2, canvas_height_px - IMG_OFFSET_Y_BOTTOM / 2), prompt, fill=text_color_prompt, font=font_large, anchor="mm")
-    
-    # --- 結束：儲存並回傳圖片 ---
+    render_mode = render_mode or RENDER_MODE
+    geometry = layout_geometry
+    with instrumentation.phase("fonts"):
+        fonts = get_fonts()
+    prompt = build_prompt(target_seat_id, customer_name)
+
+    with instrumentation.phase("compose"):
+        img = _compose_seat_canvas(target_seat_id, prompt, background_alignment, render_mode, fonts, geometry)
+    return img
+
+def _compose_seat_canvas(target_seat_id, prompt, background_alignment, render_mode, fonts, geometry):
+    match render_mode:
+        case "full":
+            img = _build_base_layer(background_alignment, fonts, geometry)
+            draw = ImageDraw.Draw(img)
+            _draw_highlight(draw, fonts, geometry, target_seat_id)
+            draw.text((geometry.canvas_width_px / 2, geometry.canvas_height_px - IMG_OFFSET_Y_BOTTOM / 2), prompt, fill=TEXT_COLOR_PROMPT, font=fonts["large"], anchor="mm")
+        case "layered":
+            img = get_base_layer(base_layer_key(geometry, background_alignment), fonts, geometry).copy()
+            draw = ImageDraw.Draw(img)
+            _draw_highlight(draw, fonts, geometry, target_seat_id)
+            draw.text((geometry.canvas_width_px / 2, geometry.canvas_height_px - IMG_OFFSET_Y_BOTTOM / 2), prompt, fill=TEXT_COLOR_PROMPT, font=fonts["large"], anchor="mm")
+        case _:
+            if render_mode != "sprite":
+                logger.warning(f"未知的繪製模式 '{render_mode}'，改用 'sprite'。")
+            base_key = base_layer_key(geometry, background_alignment)
+            img = get_base_layer(base_key, fonts, geometry).copy()
+            sprite = get_highlight_sprite(target_seat_id, base_key, fonts, geometry)
+            if sprite and sprite[0] is not None:
+                img.paste(sprite[0], sprite[1])
+            _paste_prompt_strip(img, prompt, fonts["large"], geometry)
+    return img
+
+def resolve_png_output_mode(output_mode=None):
+    output_mode = output_mode or PNG_OUTPUT_MODE
+    if output_mode == "auto":
+        # 座位圖只有少數平塗色，沒有背景照片時調色盤不會失真
+        has_background = _get_asset(BACKGROUND_IMAGE_GCS_PATH)["data"] is not None
+        return "rgba" if has_background else "palette"
+    return output_mode
+
+def encode_png_with_stats(img, output_mode=None, compress_level=None):
+    """編碼 PNG，回傳 (BytesIO, {"mode", "bytes", "encode_ms"})。"""
+    output_mode = resolve_png_output_mode(output_mode)
+    compress_level = PNG_COMPRESS_LEVEL if compress_level is None else compress_level
+    start = time.perf_counter()
+    if output_mode == "palette":
+        img = img.convert("RGB").quantize(colors=PNG_PALETTE_COLORS, method=Image.Quantize.MEDIANCUT)
+    elif output_mode != "rgba":
+        logger.warning(f"未知的 PNG 輸出模式 '{output_mode}'，改用 'rgba'。")
+        output_mode = "rgba"
     image_io = io.BytesIO()
-    img.save(image_io, 'PNG')
+    img.save(image_io, 'PNG', compress_level=compress_level)
+    encode_ms = (time.perf_counter() - start) * 1000
     image_io.seek(0)
-    return image_io
\ No newline at end of file
+    return image_io, {"mode": output_mode, "bytes": image_io.getbuffer().nbytes, "encode_ms": encode_ms}
+
+def encode_png(img, output_mode=None, compress_level=None):
+    with instrumentation.phase("encode_png"):
+        image_io, stats = encode_png_with_stats(img, output_mode, compress_level)
+    instrumentation.annotate(png_mode=stats["mode"], png_bytes=stats["bytes"])
+    logger.info(f"PNG 編碼完成: 模式={stats['mode']}, 大小={stats['bytes']} bytes, 耗時={stats['encode_ms']:.1f} ms")
+    return image_io
+
+def encode_preview(img):
+    """縮小成 LINE 預覽圖大小的 JPEG。"""
+    with instrumentation.phase("encode_preview"):
+        preview = img.convert("RGB")
+        preview.thumbnail((PREVIEW_MAX_SIZE_PX, PREVIEW_MAX_SIZE_PX), Image.Resampling.LANCZOS)
+        preview_io = io.BytesIO()
+        preview.save(preview_io, 'JPEG', quality=PREVIEW_JPEG_QUALITY, optimize=True)
+        preview_io.seek(0)
+    return preview_io
+
+def create_seat_image(target_seat_id, customer_name, background_alignment="左上角", render_mode=None):
+    """產生座位圖並編碼為 PNG (BytesIO)，參數同 render_seat_canvas。"""
+    img = render_seat_canvas(target_seat_id, customer_name, background_alignment, render_mode)
+    if img is None:
+        return None
+    return encode_png(img)
+
+def create_seat_image_with_preview(target_seat_id, customer_name, background_alignment="左上角", render_mode=None):
+    """同一次繪製產生 (原圖 PNG, 預覽圖 JPEG)；失敗時回傳 (None, None)。"""
+    img = render_seat_canvas(target_seat_id, customer_name, background_alignment, render_mode)
+    if img is None:
+        return None, None
+    return encode_png(img), encode_preview(img)
@@ -0,0 +1,87 @@
+import contextvars
+import json
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+
+# 輕量的請求計時：每個 webhook 事件建立一個 trace，各階段以 phase() 記錄 monotonic 耗時，
+# 事件處理結束時輸出一行 JSON 日誌，方便在 Cloud Logging 中篩選與統計。
+
+logger = logging.getLogger(__name__)
+_current_trace = contextvars.ContextVar("request_trace", default=None)
+
+class RequestTrace:
+    def __init__(self, request_id=None, **fields):
+        self.request_id = request_id or uuid.uuid4().hex[:12]
+        self.fields = dict(fields)
+        self.phases_ms = {}
+        self.started_at = time.monotonic()
+
+    def add_phase(self, name, duration_ms):
+        # 同一階段出現多次 (如兩個素材) 時累加
+        self.phases_ms[name] = self.phases_ms.get(name, 0.0) + duration_ms
+
+    def to_dict(self):
+        return {
+            "request_id": self.request_id,
+            "total_ms": round((time.monotonic() - self.started_at) * 1000, 2),
+            "phases_ms": {name: round(ms, 2) for name, ms in self.phases_ms.items()},
+            **self.fields,
+        }
+
+def current_trace():
+    return _current_trace.get()
+
+@contextmanager
+def trace_request(request_id=None, **fields):
+    """為一個 webhook 事件建立 trace，結束時輸出一行結構化日誌。"""
+    trace = RequestTrace(request_id, **fields)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        logger.info(f"請求計時 {json.dumps(trace.to_dict(), ensure_ascii=False, default=str)}")
+
+@contextmanager
+def collect_phases(**fields):
+    """
+    在另一個程序 (如繪圖子程序) 中收集階段耗時與註記，不輸出日誌；
+    結束後把 trace.phases_ms 與 trace.fields 傳回呼叫端，以 merge() 併入呼叫端的 trace。
+    """
+    trace = RequestTrace(**fields)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+def merge(phases_ms, fields=None):
+    """把 collect_phases() 收集到的結果併入目前的 trace；不在 trace 之內時不做任何事。"""
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    for name, duration_ms in phases_ms.items():
+        trace.add_phase(name, duration_ms)
+    if fields:
+        trace.fields.update(fields)
+
+@contextmanager
+def phase(name):
+    """記錄一個階段的耗時；不在 trace 之內時 (如 pre.py) 不做任何事。"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        trace.add_phase(name, (time.monotonic() - start) * 1000)
+
+def annotate(**fields):
+    """在目前的 trace 上附加欄位 (如座位、是否命中快取)。"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.fields.update(fields)
@@ -1,32 +1,401 @@
+import argparse
+import io
+import json
 import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, wait
 import image_generator
 import gcs_function
+import render_service
 
 # 初始化日誌
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(module)s - %(funcName)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 批次預先產生座位圖：程序池繪圖 → 有上限的佇列 → 上傳執行緒池，繪圖與上傳同時進行。
+# 用法：python pre.py --render-processes 4 --upload-threads 8
+# 上次產生的結果記錄在 GCS 上的清單 (manifest) 中，只重新產生內容雜湊改變的圖片。
+# 執行中每確認上傳一張就寫入本機進度檔，中斷後重新執行會從進度檔繼續。
+
+MANIFEST_GCS_PATH = "manifests/seat_maps.json"
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CHECKPOINT_PATH = os.path.join(_BASE_DIR, "pre_checkpoint.json")
+DEFAULT_FAILURES_PATH = os.path.join(_BASE_DIR, "pre_failures.json")
+UPLOAD_RETRY_BASE_SECONDS = 1.0
+
+# manifest_key 為不含內容雜湊的基本路徑 (每位賓客或每個座位一個)
+RenderJob = namedtuple("RenderJob", ["label", "seat_id", "customer_name", "manifest_key", "content_hash", "image_gcs_path"])
+
+class RenderManifest:
+    """
+    每位賓客 (座位共用模式為每個座位) 一筆記錄：內容雜湊 (座位、佈局、素材、繪圖程式版本與輸出設定)
+    與對應的物件路徑。雜湊相同且物件仍存在的賓客不需重新產生。
+    """
+
+    def __init__(self, entries=None):
+        self.entries = dict(entries or {})
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls):
+        manifest_io = gcs_function.download_from_gcs(MANIFEST_GCS_PATH)
+        if manifest_io is None:
+            logger.info("尚無產生記錄，將產生所有圖片。")
+            return cls()
+        try:
+            return cls(json.load(manifest_io).get("entries", {}))
+        except Exception as e:
+            logger.error(f"產生記錄格式錯誤，將產生所有圖片: {e}", exc_info=True)
+            return cls()
+
+    def save(self):
+        with self._lock:
+            payload = {
+                "renderer_version": image_generator.RENDERER_VERSION,
+                "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "entries": self.entries,
+            }
+            data = json.dumps(payload, ensure_ascii=False, indent=1, sort_keys=True).encode('utf-8')
+        return gcs_function.upload_to_gcs(io.BytesIO(data), MANIFEST_GCS_PATH, content_type='application/json', cache_control='no-cache')
+
+    def is_current(self, job):
+        entry = self.entries.get(job.manifest_key)
+        return entry is not None and entry["content_hash"] == job.content_hash and entry["image_gcs_path"] == job.image_gcs_path
+
+    def record(self, job):
+        """記錄上傳完成的圖片，回傳被取代的舊記錄 (沒有時為 None)。"""
+        with self._lock:
+            previous = self.entries.get(job.manifest_key)
+            self.entries[job.manifest_key] = {
+                "label": job.label,
+                "seat": job.seat_id,
+                "content_hash": job.content_hash,
+                "image_gcs_path": job.image_gcs_path,
+                "preview_gcs_path": image_generator.get_preview_gcs_path(job.image_gcs_path),
+            }
+            return previous
+
+    def remove(self, manifest_key):
+        with self._lock:
+            return self.entries.pop(manifest_key, None)
+
+    def merge(self, entries):
+        with self._lock:
+            self.entries.update(entries)
+
+def write_json_atomic(path, payload):
+    """先寫入暫存檔再以 os.replace 取代，中斷時檔案不會只寫一半。"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class CheckpointJournal:
+    """本機進度檔：記錄本次執行中已確認上傳的圖片 (格式同產生記錄)，產生記錄成功存回 GCS 後刪除。"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                payload = json.load(f)
+        except Exception as e:
+            logger.error(f"讀取進度檔失敗，將不使用上次的進度: {e}", exc_info=True)
+            return {}
+        if payload.get("bucket") != image_generator.GCS_BUCKET_NAME:
+            logger.warning(f"進度檔屬於其他 bucket ({payload.get('bucket')})，忽略。")
+            return {}
+        self.entries = dict(payload.get("entries", {}))
+        return dict(self.entries)
+
+    def record(self, manifest_key, entry):
+        with self._lock:
+            self.entries[manifest_key] = entry
+            write_json_atomic(self.path, {"bucket": image_generator.GCS_BUCKET_NAME, "entries": self.entries})
+
+    def clear(self):
+        with self._lock:
+            self.entries = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+class Progress:
+    """彙整上傳結果，定期輸出進度與預估剩餘時間。"""
+
+    def __init__(self, total, interval_seconds=2.0):
+        self.total = total
+        self.interval_seconds = interval_seconds
+        self.succeeded = 0
+        self.failed = []
+        self.bytes_uploaded = 0
+        self.started_at = time.monotonic()
+        self._last_report_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.succeeded + len(self.failed)
+
+    def record(self, job, ok, size_bytes=0, reason=None):
+        with self._lock:
+            if ok:
+                self.succeeded += 1
+                self.bytes_uploaded += size_bytes
+            else:
+                self.failed.append((job, reason))
+            now = time.monotonic()
+            if now - self._last_report_at >= self.interval_seconds or self.done == self.total:
+                self._last_report_at = now
+                self._report(now)
+
+    def _report(self, now):
+        elapsed = now - self.started_at
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate > 0 else 0.0
+        percent = self.done / self.total * 100 if self.total else 100.0
+        logger.info(f"進度 {self.done}/{self.total} ({percent:.1f}%)，失敗 {len(self.failed)}，{rate:.2f} 張/秒，預估剩餘 {eta:.0f} 秒")
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started_at
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        logger.info(
+            f"完成：成功 {self.succeeded}，失敗 {len(self.failed)}，共 {self.total} 張；"
+            f"耗時 {elapsed:.1f} 秒，{rate:.2f} 張/秒，上傳 {self.bytes_uploaded / 1024 / 1024:.1f} MB。"
+        )
+        for job, reason in self.failed:
+            logger.error(f"產生失敗: {job.label} (座位: {job.seat_id}, 路徑: {job.image_gcs_path})：{reason}")
+
+    def write_failures(self, path):
+        """把無法完成的項目寫成 JSON 供後續處理；沒有失敗時移除舊的檔案。"""
+        if not self.failed:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        try:
+            write_json_atomic(path, [
+                {"label": job.label, "seat": job.seat_id, "image_gcs_path": job.image_gcs_path, "reason": reason}
+                for job, reason in self.failed
+            ])
+        except OSError as e:
+            # 失敗項目已列在日誌中；寫檔失敗不應阻止後續儲存產生記錄
+            logger.error(f"無法寫入失敗清單 {path}: {e}")
+            return
+        logger.warning(f"{len(self.failed)} 張圖片無法完成，清單已寫入 {path}")
+
+def make_job(label, seat_id, customer_name, base_gcs_path):
+    content_hash = image_generator.image_content_hash(seat_id, customer_name)
+    return RenderJob(label, seat_id, customer_name, base_gcs_path, content_hash,
+                     image_generator.versioned_image_path_for_hash(base_gcs_path, content_hash))
+
+def build_jobs():
+    if image_generator.is_seat_sharing_mode():
+        # 座位共用模式：每個座位只產生一張圖
+        seat_ids = sorted({customer.get("seat") for customer in image_generator.customer_list if customer.get("seat")})
+        logger.info(f"座位共用模式：{len(image_generator.customer_list)} 位賓客共 {len(seat_ids)} 個座位。")
+        return [make_job(f"座位 {seat_id}", seat_id, None, image_generator.get_gcs_image_path_for_seat(seat_id)) for seat_id in seat_ids]
+
+    jobs = []
+    for customer in image_generator.customer_list:
+        customer_name = customer.get("name")
+        seat_id = customer.get("seat")
+        category = customer.get("category")
+        jobs.append(make_job(customer_name, seat_id, customer_name, image_generator.get_gcs_image_path_for_customer(customer_name, category)))
+    return jobs
+
+def plan_jobs(jobs, manifest, full=False, resumed_entries=None):
+    """
+    依產生記錄挑出需要重新產生的圖片，回傳 (待產生, 已是最新的數量, 已不在名單中的記錄 key)。
+    resumed_entries 為上次中斷前已確認上傳的記錄，即使指定 full 也不再重新產生。
+    """
+    resumed_entries = resumed_entries or {}
+    if not full:
+        # 記錄相符但物件已被刪除時仍需重新產生
+        try:
+            gcs_function.load_existence_index(f"{image_generator.GCS_IMAGE_DIR}/")
+        except Exception as e:
+            logger.warning(f"載入圖片存在索引失敗，將逐一查詢 GCS: {e}")
+    def already_uploaded(job):
+        entry = resumed_entries.get(job.manifest_key)
+        return entry is not None and entry["image_gcs_path"] == job.image_gcs_path
+    pending = [
+        job for job in jobs
+        if not already_uploaded(job)
+        and (full or not (manifest.is_current(job) and gcs_function.check_image_exists_gcs(job.image_gcs_path)))
+    ]
+    current_keys = {job.manifest_key for job in jobs}
+    removed_keys = [key for key in manifest.entries if key not in current_keys]
+    return pending, len(jobs) - len(pending), removed_keys
+
+def delete_entry_objects(entry):
+    gcs_function.delete_from_gcs(entry["image_gcs_path"])
+    gcs_function.delete_from_gcs(entry["preview_gcs_path"])
+
+def upload_with_retry(job, png_bytes, preview_bytes, save_local, retries):
+    """上傳原圖與預覽圖，任一失敗時以指數退避重試；兩者都完成才算成功。"""
+    for attempt in range(retries + 1):
+        image_url, preview_url = gcs_function.upload_image_with_preview(
+            io.BytesIO(png_bytes), io.BytesIO(preview_bytes) if preview_bytes else None,
+            job.image_gcs_path, image_generator.get_preview_gcs_path(job.image_gcs_path), save_local=save_local
+        )
+        if image_url is not None and (preview_bytes is None or preview_url is not None):
+            return True
+        if attempt < retries:
+            delay = UPLOAD_RETRY_BASE_SECONDS * (2 ** attempt) * random.uniform(0.5, 1.5)
+            logger.warning(f"上傳 {job.label} 失敗，{delay:.1f} 秒後重試 ({attempt + 1}/{retries})。")
+            time.sleep(delay)
+    return False
+
+def upload_worker(upload_queue, progress, save_local, on_uploaded, retries):
+    while True:
+        item = upload_queue.get()
+        if item is None:
+            return
+        job, png_bytes, preview_bytes = item
+        size_bytes = len(png_bytes) + len(preview_bytes or b"")
+        # 任何例外都只記為這一張失敗，執行緒必須繼續運作，否則繪圖端放入佇列時會永遠等待
+        try:
+            uploaded = upload_with_retry(job, png_bytes, preview_bytes, save_local, retries)
+            if uploaded and on_uploaded is not None:
+                on_uploaded(job)
+        except Exception as e:
+            logger.error(f"處理 {job.label} 的上傳結果失敗: {e}", exc_info=True)
+            progress.record(job, False, size_bytes, reason=f"記錄進度失敗: {e}")
+            continue
+        progress.record(job, uploaded, size_bytes, reason=None if uploaded else f"上傳失敗 (已重試 {retries} 次)")
+
+def hand_off(job, render_result, upload_queue, progress):
+    # 佇列已滿時在此等待，繪圖速度不會超過上傳太多
+    png_bytes, preview_bytes = render_result.png_bytes, render_result.preview_bytes
+    if png_bytes is None:
+        progress.record(job, False, reason="繪製失敗")
+        return
+    if render_result.content_hash != job.content_hash:
+        # 素材在規劃後更新，子程序以新版本繪製：改用實際的內容雜湊命名並記錄到 manifest
+        logger.warning(f"{job.label} 的素材版本在產生期間改變，改存為新版本 ({render_result.content_hash})。")
+        job = job._replace(content_hash=render_result.content_hash,
+                           image_gcs_path=image_generator.versioned_image_path_for_hash(job.manifest_key, render_result.content_hash))
+    upload_queue.put((job, png_bytes, preview_bytes))
+
+def run_pipeline(jobs, render_processes, upload_threads, queue_size, on_uploaded=None, retries=3):
+    progress = Progress(len(jobs))
+    upload_queue = queue.Queue(maxsize=queue_size)
+    save_local = not image_generator.IS_LOCAL
+    uploaders = [
+        threading.Thread(target=upload_worker, args=(upload_queue, progress, save_local, on_uploaded, retries), name=f"uploader-{i}", daemon=True)
+        for i in range(upload_threads)
+    ]
+    for uploader in uploaders:
+        uploader.start()
+
+    if render_processes <= 0:
+        for job in jobs:
+            hand_off(job, render_service.render_in_process(job.seat_id, job.customer_name, expected_hash=job.content_hash), upload_queue, progress)
+    else:
+        # 同時送出的繪圖工作數有上限，避免所有結果都堆在記憶體中
+        max_in_flight = render_processes * 2
+        in_flight = {}
+
+        def collect(futures):
+            for future in futures:
+                job = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f"繪製 {job.label} 時發生例外: {e}", exc_info=True)
+                    result = render_service.FAILED_RESULT
+                hand_off(job, result, upload_queue, progress)
+
+        for job in jobs:
+            in_flight[render_service.submit(job.seat_id, job.customer_name, expected_hash=job.content_hash)] = job
+            if len(in_flight) >= max_in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            collect(done)
+
+    for _ in uploaders:
+        upload_queue.put(None)
+    for uploader in uploaders:
+        uploader.join()
+    progress.summary()
+    return progress
+
 def main():
+    parser = argparse.ArgumentParser(description="批次預先產生座位圖並上傳至 GCS")
+    parser.add_argument("--key", default="marryme-461108-796e200900bb.json", help="GCS 服務帳號金鑰檔 (與此檔同一層目錄)")
+    parser.add_argument("--render-processes", type=int, default=render_service.RENDER_PROCESSES, help="繪圖子程序數，0 表示在主程序中繪製")
+    parser.add_argument("--upload-threads", type=int, default=8, help="同時上傳的執行緒數")
+    parser.add_argument("--queue-size", type=int, default=32, help="等待上傳的圖片數上限")
+    parser.add_argument("--full", action="store_true", help="忽略產生記錄，重新產生所有圖片")
+    parser.add_argument("--retries", type=int, default=3, help="上傳失敗時的重試次數")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT_PATH, help="中斷後可繼續的本機進度檔")
+    parser.add_argument("--failures-file", default=DEFAULT_FAILURES_PATH, help="無法完成的項目清單")
+    parser.add_argument("--prune-stale", action="store_true",
+                        help="刪除被新版本取代的舊圖片 (Bot 仍使用舊名單時會找不到圖片，請在 Bot 更新後再使用)")
+    args = parser.parse_args()
+
     # 呼叫共用模組的初始化函式，並傳入本機的服務帳號金鑰路徑
     try:
         # 假設您的金鑰檔和 pre.py 在同一層目錄
-        image_generator.initialize_dependencies("marryme-461108-796e200900bb.json")
+        image_generator.initialize_dependencies(args.key)
     except Exception as e:
         logger.critical(f"連接 GCS 失敗: {e}", exc_info=True)
         return
-        
+
     if not image_generator.customer_list:
         logger.error("賓客名單為空，無法繼續。")
         return
-    
-    for customer in image_generator.customer_list:
-        customer_name = customer.get("name")
-        seat_id = customer.get("seat")
-        category = customer.get("category")
-        
-        image_gcs_path = image_generator.get_gcs_image_path_for_customer(customer_name, category)
-        image_io = image_generator.create_seat_image(seat_id, customer_name, "延展")
-        gcs_function.upload_to_gcs(image_io, image_gcs_path, save_local=not image_generator.IS_LOCAL)
+
+    manifest = RenderManifest.load()
+    journal = CheckpointJournal(args.checkpoint)
+    resumed_entries = journal.load()
+    if resumed_entries:
+        # 上次中斷前已確認上傳的圖片併入產生記錄，不再重新產生
+        logger.info(f"從上次中斷的進度繼續：已完成 {len(resumed_entries)} 張。")
+        manifest.merge(resumed_entries)
+    jobs, unchanged_count, removed_keys = plan_jobs(build_jobs(), manifest, args.full, resumed_entries)
+    logger.info(f"需產生 {len(jobs)} 張圖片 (未變更 {unchanged_count} 張，已移除 {len(removed_keys)} 筆)："
+                f"{args.render_processes} 個繪圖子程序、{args.upload_threads} 個上傳執行緒。")
+
+    def on_uploaded(job):
+        previous = manifest.record(job)
+        journal.record(job.manifest_key, manifest.entries[job.manifest_key])
+        if args.prune_stale and previous and previous["image_gcs_path"] != job.image_gcs_path:
+            delete_entry_objects(previous)
+
+    if jobs:
+        render_service.start(args.key, processes=args.render_processes)
+        try:
+            progress = run_pipeline(jobs, args.render_processes, max(1, args.upload_threads), max(1, args.queue_size),
+                                    on_uploaded, max(0, args.retries))
+        finally:
+            render_service.shutdown()
+        progress.write_failures(args.failures_file)
+
+    # 已不在名單中的賓客 (或座位)：刪除圖片並移除記錄
+    for manifest_key in removed_keys:
+        entry = manifest.remove(manifest_key)
+        logger.info(f"'{entry['label']}' 已不在名單中，刪除其座位圖。")
+        delete_entry_objects(entry)
+
+    if jobs or removed_keys or resumed_entries:
+        if manifest.save():
+            journal.clear()
+        else:
+            logger.error(f"產生記錄存回 GCS 失敗，保留進度檔 {args.checkpoint}，下次執行時會繼續。")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
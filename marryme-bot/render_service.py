@@ -0,0 +1,166 @@
+import logging
+import multiprocessing
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import image_generator
+import instrumentation
+
+# 座位圖繪製服務：Pillow 繪圖是 CPU 密集的工作，放在常駐的子程序中執行，
+# 不與 webhook 處理執行緒競爭 GIL，繪圖吞吐量可隨 CPU 核心數增加。
+# 每個子程序啟動時自行初始化 (名單、佈局幾何、字型、素材與底圖)，之後每個工作只需繪製與編碼。
+# 子程序以 spawn 啟動，會以 __mp_main__ 的名稱重新匯入主程式模組 (直接執行 python app.py 時為 app.py)；
+# 主程式的伺服器初始化必須避開 __mp_main__，見 app.IS_SPAWNED_CHILD。
+
+logger = logging.getLogger(__name__)
+
+RENDER_PROCESSES = int(os.environ.get('RENDER_PROCESSES', os.cpu_count() or 1))  # 0 表示在目前程序中繪製
+RENDER_TIMEOUT_SECONDS = float(os.environ.get('RENDER_TIMEOUT_SECONDS', 20))
+
+_executor = None
+_executor_lock = threading.Lock()  # 保護程序池的替換，避免多個執行緒同時重建
+_init_args = (None, None, None)  # start() 的參數，重建程序池時沿用
+_SUBMIT_ATTEMPTS = 2
+# 素材重新載入的次數：主程序每次 reload_assets() 加一並隨每個工作送出，
+# 子程序發現比自己看過的新時先重新驗證素材 (程序池無法直接通知每個子程序)
+_asset_epoch = 0
+
+# 繪圖結果；content_hash 是繪製時實際使用的素材與設定算出的內容雜湊 (物件名稱應以此為準)。
+# phases_ms 與 fields 是繪製時記錄的各階段耗時與註記 (子程序中沒有請求的 trace)，
+# 由 render() 併入呼叫端的 trace，每個事件的計時日誌仍列出素材、底圖、合成與編碼等階段
+RenderResult = namedtuple("RenderResult", ["png_bytes", "preview_bytes", "content_hash", "phases_ms", "fields"])
+FAILED_RESULT = RenderResult(None, None, None, {}, {})
+
+def _init_worker(gcs_service_account_path, data_dir):
+    image_generator.initialize_dependencies(gcs_service_account_path, data_dir)
+    # 預先下載素材並建立底圖，第一個工作不需等待
+    seat_ids = list(image_generator.table_locations)
+    if seat_ids:
+        image_generator.render_seat_canvas(seat_ids[0], None, image_generator.BACKGROUND_ALIGNMENT)
+    logger.info(f"繪圖子程序 {os.getpid()} 初始化完成。")
+
+def render_in_process(target_seat_id, customer_name, options=None, expected_hash=None, asset_epoch=None):
+    """
+    繪製一張座位圖，回傳 RenderResult；失敗時 png_bytes 為 None。
+
+    options 可包含 background_alignment 與 render_mode，未指定時使用 image_generator 的預設值。
+    expected_hash 為呼叫端依自己的素材快取算出的內容雜湊；與此程序不同時先重新驗證素材，
+    兩邊的素材快取各自到期，素材剛更新時可能看到不同版本。
+    asset_epoch 為主程序的素材重新載入次數，大於此程序看過的次數時先重新驗證素材。
+    """
+    global _asset_epoch
+    options = options or {}
+    if asset_epoch is not None and asset_epoch > _asset_epoch:
+        image_generator.reload_assets()
+        _asset_epoch = asset_epoch
+    alignment = options.get("background_alignment", image_generator.BACKGROUND_ALIGNMENT)
+    with instrumentation.collect_phases() as trace:
+        content_hash = image_generator.image_content_hash(target_seat_id, customer_name, alignment)
+        if expected_hash is not None and content_hash != expected_hash:
+            image_generator.reload_assets()
+            content_hash = image_generator.image_content_hash(target_seat_id, customer_name, alignment)
+        for _ in range(2):
+            image_io, preview_io = image_generator.create_seat_image_with_preview(
+                target_seat_id, customer_name, alignment, options.get("render_mode"),
+            )
+            # 繪製期間素材快取到期並換了版本時重新繪製一次，確保雜湊與圖片內容一致
+            rendered_hash = image_generator.image_content_hash(target_seat_id, customer_name, alignment)
+            if rendered_hash == content_hash:
+                break
+            content_hash = rendered_hash
+    if image_io is None:
+        return RenderResult(None, None, None, trace.phases_ms, trace.fields)
+    return RenderResult(image_io.getvalue(), preview_io.getvalue() if preview_io else None, content_hash,
+                        trace.phases_ms, trace.fields)
+
+def start(gcs_service_account_path=None, data_dir=None, processes=None):
+    """建立繪圖程序池；參數與 image_generator.initialize_dependencies 相同。"""
+    with _executor_lock:
+        _start_locked(gcs_service_account_path, data_dir, processes)
+
+def _start_locked(gcs_service_account_path, data_dir, processes=None):
+    global _executor, _init_args
+    processes = RENDER_PROCESSES if processes is None else processes
+    _init_args = (gcs_service_account_path, data_dir, processes)
+    if processes <= 0:
+        logger.info("RENDER_PROCESSES=0，座位圖在目前程序中繪製。")
+        return
+    # spawn：子程序重新建立 GCS client，不沿用父程序的連線與執行緒
+    _executor = ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(gcs_service_account_path, data_dir),
+    )
+    logger.info(f"繪圖程序池已啟動: {processes} 個子程序。")
+
+def submit(target_seat_id, customer_name, options=None, expected_hash=None):
+    """送出繪圖工作並回傳 Future；未啟用程序池時回傳 None。"""
+    if _executor is None:
+        return None
+    return _executor.submit(render_in_process, target_seat_id, customer_name, options, expected_hash, _asset_epoch)
+
+def _replace_broken_pool(broken):
+    """
+    重建損壞的程序池並回傳目前的程序池。只有 broken 仍是目前的程序池時才關閉它：
+    多個執行緒同時發現損壞時，第一個重建，其餘直接使用新的程序池，不會把新程序池上的工作取消。
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is broken:
+            _executor = None
+            broken.shutdown(wait=False, cancel_futures=True)
+            _start_locked(*_init_args)
+        return _executor
+
+def render(target_seat_id, customer_name, options=None, timeout=None, expected_hash=None):
+    """
+    在程序池中繪製座位圖並等待結果 (最多 timeout 秒)，回傳值同 render_in_process，並把繪製的計時併入目前的 trace。
+    逾時回傳 FAILED_RESULT；程序池損壞時重新建立並重新送出一次。
+    回傳的 content_hash 與 expected_hash 不同時，表示本程序的素材快取較舊：立即重新驗證，
+    呼叫端應改用 content_hash 組成物件名稱。
+    """
+    result = _render(target_seat_id, customer_name, options, timeout, expected_hash)
+    instrumentation.merge(result.phases_ms, result.fields)
+    if result.png_bytes is not None and expected_hash is not None and result.content_hash != expected_hash:
+        logger.warning(f"座位 '{target_seat_id}' 繪製時的內容雜湊 {result.content_hash} 與預期 {expected_hash} 不同，重新驗證素材。")
+        image_generator.reload_assets()
+    return result
+
+def _render(target_seat_id, customer_name, options, timeout, expected_hash):
+    timeout = RENDER_TIMEOUT_SECONDS if timeout is None else timeout
+    executor = _executor
+    if executor is None:
+        return render_in_process(target_seat_id, customer_name, options, expected_hash)
+    for attempt in range(1, _SUBMIT_ATTEMPTS + 1):
+        try:
+            return executor.submit(render_in_process, target_seat_id, customer_name, options, expected_hash,
+                                   _asset_epoch).result(timeout=timeout)
+        except FutureTimeoutError:
+            logger.error(f"繪製座位 '{target_seat_id}' 逾時 ({timeout} 秒)。")
+            return FAILED_RESULT
+        except BrokenProcessPool as e:
+            logger.error(f"繪圖程序池已損壞 (第 {attempt} 次)，重新建立: {e}", exc_info=True)
+            executor = _replace_broken_pool(executor)
+            if executor is None:  # 已關閉 (程序結束中)
+                return FAILED_RESULT
+    logger.error(f"繪製座位 '{target_seat_id}' 失敗：程序池連續損壞。")
+    return FAILED_RESULT
+
+def reload_assets():
+    """背景圖或 LOGO 更新後呼叫：本程序立即重新驗證素材，每個繪圖子程序在下一個工作開始前重新驗證。"""
+    global _asset_epoch
+    image_generator.reload_assets()
+    with _executor_lock:
+        _asset_epoch += 1
+        return _asset_epoch
+
+def shutdown(wait=True):
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait, cancel_futures=True)
+        logger.info("繪圖程序池已關閉。")
@@ -0,0 +1,128 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+import instrumentation
+
+try:
+    import fcntl
+except ImportError:  # Windows 本機執行時只做同一程序內的合併
+    fcntl = None
+
+# 同一張圖的並行產生請求合併 (single-flight)：同一個 key 同時只有一個執行者，
+# 其他請求等待它完成後重新確認圖片是否已存在，而不是各自繪製、上傳同一張圖。
+# 同一程序內的執行緒以 threading.Lock 等待；同一台機器上的 gunicorn worker 程序以鎖定檔 (flock) 等待。
+# 鎖定檔依 key 的雜湊分成固定數量的分區，檔案數量不會隨圖片增加 (Cloud Run 的 /tmp 佔用記憶體)；
+# 不同 key 落在同一分區時只會互相多等一次，等待後重新確認圖片是否存在，結果仍正確。
+# 執行者可以先以 release_local() 放行同一程序內的等待者 (如圖片已放入記憶體快取)，
+# 上傳完成後再以 release() 釋放鎖定檔；等待者以 acquire 的 is_done 確認結果後不再等待鎖定檔。
+
+logger = logging.getLogger(__name__)
+
+SINGLE_FLIGHT_LOCK_DIR = os.environ.get('SINGLE_FLIGHT_LOCK_DIR', os.path.join(tempfile.gettempdir(), "marryme-single-flight"))
+SINGLE_FLIGHT_TIMEOUT_SECONDS = float(os.environ.get('SINGLE_FLIGHT_TIMEOUT_SECONDS', 30))
+SINGLE_FLIGHT_LOCK_STRIPES = int(os.environ.get('SINGLE_FLIGHT_LOCK_STRIPES', 256))
+_LOCK_POLL_SECONDS = 0.05
+
+_inflight = {}  # key -> {"lock": threading.Lock, "refs": 等待中與執行中的請求數}
+_inflight_lock = threading.Lock()
+
+class Flight:
+    """一次取得的執行權；waited 為 True 表示曾等待其他執行者，應先重新確認結果是否已存在。"""
+
+    def __init__(self, key, waited, lock_file):
+        self.key = key
+        self.waited = waited
+        self._lock_file = lock_file
+        self._released = False
+        self._local_released = False
+
+    def release(self):
+        # 可在其他執行緒呼叫 (如背景上傳完成後)，重複呼叫不會出錯
+        if self._released:
+            return
+        self._released = True
+        if self._lock_file is not None:
+            try:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+            finally:
+                self._lock_file.close()
+        self.release_local()
+
+    def release_local(self):
+        """只放行同一程序內的等待者，鎖定檔保留到 release()。"""
+        if self._local_released:
+            return
+        self._local_released = True
+        with _inflight_lock:
+            entry = _inflight[self.key]
+            entry["lock"].release()
+            entry["refs"] -= 1
+            if entry["refs"] == 0:
+                del _inflight[self.key]
+
+def _lock_file_path(key):
+    stripe = int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16) % max(1, SINGLE_FLIGHT_LOCK_STRIPES)
+    return os.path.join(SINGLE_FLIGHT_LOCK_DIR, f"stripe-{stripe:03d}.lock")
+
+def _acquire_file_lock(key, deadline):
+    """回傳 (鎖定檔, 是否曾等待)；逾時或無法建立鎖定檔時回傳 (None, 是否曾等待)，不阻擋請求。"""
+    if fcntl is None:
+        return None, False
+    try:
+        os.makedirs(SINGLE_FLIGHT_LOCK_DIR, exist_ok=True)
+        lock_file = open(_lock_file_path(key), "a")
+    except OSError as e:
+        logger.warning(f"無法建立鎖定檔，僅合併同一程序內的請求 ({key}): {e}")
+        return None, False
+    waited = False
+    while True:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file, waited
+        except BlockingIOError:
+            waited = True
+            if time.monotonic() >= deadline:
+                lock_file.close()
+                logger.warning(f"等待其他程序產生 '{key}' 逾時，改為自行產生。")
+                return None, waited
+            time.sleep(_LOCK_POLL_SECONDS)
+
+def acquire(key, timeout=None, is_done=None):
+    """
+    取得 key 的執行權，必要時等待目前的執行者完成 (最多 timeout 秒，逾時後仍放行)。
+    呼叫者完成後必須呼叫 Flight.release()。
+    is_done 為可選的檢查函式：在同一程序內等待過後呼叫，回傳 True 時表示結果已可使用，
+    不再等待其他程序的鎖定檔 (前一個執行者可能仍持有鎖定檔上傳中)。
+    """
+    timeout = SINGLE_FLIGHT_TIMEOUT_SECONDS if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    with _inflight_lock:
+        entry = _inflight.setdefault(key, {"lock": threading.Lock(), "refs": 0})
+        entry["refs"] += 1
+    with instrumentation.phase("single_flight_wait"):
+        waited = not entry["lock"].acquire(blocking=False)
+        if waited and not entry["lock"].acquire(timeout=timeout):
+            # 逾時仍放行，避免前一個執行者卡住時所有請求都跟著失敗
+            with _inflight_lock:
+                entry["refs"] -= 1
+            logger.warning(f"等待同一程序內產生 '{key}' 逾時，改為自行產生。")
+            return _UncoordinatedFlight(key)
+        if waited and is_done is not None and is_done():
+            return Flight(key, True, None)
+        lock_file, waited_for_process = _acquire_file_lock(key, deadline)
+    return Flight(key, waited or waited_for_process, lock_file)
+
+class _UncoordinatedFlight(Flight):
+    """等待逾時時回傳，不持有任何鎖。"""
+
+    def __init__(self, key):
+        super().__init__(key, True, None)
+
+    def release(self):
+        self._released = True
+
+    def release_local(self):
+        self._local_released = True
@@ -0,0 +1,196 @@
+import os
+import threading
+import uuid
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+# 物件儲存後端：gcs_function 只透過這裡的介面存取物件，不直接呼叫 google.cloud.storage。
+# 三種實作介面相同：
+#   exists(path) / get(path, generation=None) -> bytes 或 None / put(path, data, content_type, cache_control)
+#   list(prefix) -> 物件名稱集合 / delete(path) -> 是否曾存在 / stat(path) -> {"generation", "etag", "size"} 或 None
+# get 指定 generation 時只在物件仍是該版本時回傳內容 (已被覆寫或刪除時回傳 None)，
+# 讀取端可先以 stat 取得 generation，再確保下載到的內容就是那個版本。
+# 以 STORAGE_BACKEND 選擇：gcs (預設)、local (本機目錄，場地網路不穩時使用)、memory (測試與效能量測，不持久)。
+
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'gcs')
+STORAGE_LOCAL_DIR = os.environ.get('STORAGE_LOCAL_DIR', 'local_storage')  # 相對路徑以資料目錄為基準
+
+class GCSStorage:
+    kind = "gcs"
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.name = bucket.name
+
+    def uri(self, path):
+        return f"gs://{self.name}/{path}"
+
+    def public_url(self, path):
+        return f"https://storage.googleapis.com/{self.name}/{path}"
+
+    def exists(self, path):
+        return self.bucket.blob(path).exists()
+
+    def get(self, path, generation=None):
+        # 直接下載，不先取 metadata (一次請求)；if_generation_match 由 GCS 保證內容與 generation 一致
+        try:
+            return self.bucket.blob(path).download_as_bytes(if_generation_match=generation)
+        except (NotFound, PreconditionFailed):
+            return None
+
+    def put(self, path, data, content_type='application/octet-stream', cache_control=None):
+        blob = self.bucket.blob(path)
+        if cache_control:
+            blob.cache_control = cache_control
+        blob.upload_from_string(data, content_type=content_type)
+
+    def list(self, prefix=""):
+        return {blob.name for blob in self.bucket.list_blobs(prefix=prefix)}
+
+    def delete(self, path):
+        blob = self.bucket.blob(path)
+        if not blob.exists():
+            return False
+        blob.delete()
+        return True
+
+    def stat(self, path):
+        blob = self.bucket.get_blob(path)  # 只取 metadata
+        if blob is None:
+            return None
+        return {"generation": blob.generation, "etag": blob.etag, "size": blob.size}
+
+class LocalStorage:
+    """物件存放在 root 目錄下，物件名稱即相對路徑；以檔案修改時間 (ns) 作為 generation。"""
+    kind = "local"
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.name = self.root
+        os.makedirs(self.root, exist_ok=True)
+
+    def _file_path(self, path):
+        file_path = os.path.abspath(os.path.join(self.root, path))
+        if os.path.commonpath([self.root, file_path]) != self.root:
+            raise ValueError(f"物件路徑超出儲存目錄: {path}")
+        return file_path
+
+    def uri(self, path):
+        return f"file://{self._file_path(path)}"
+
+    def public_url(self, path):
+        return self.uri(path)
+
+    def exists(self, path):
+        return os.path.isfile(self._file_path(path))
+
+    def get(self, path, generation=None):
+        # put 以 os.replace 換掉整個檔案，已開啟的檔案內容與 fstat 的修改時間一致
+        try:
+            with open(self._file_path(path), 'rb') as f:
+                if generation is not None and os.fstat(f.fileno()).st_mtime_ns != generation:
+                    return None
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, path, data, content_type='application/octet-stream', cache_control=None):
+        # 先寫入暫存檔再取代，讀取端不會看到寫到一半的檔案
+        file_path = self._file_path(path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, file_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def list(self, prefix=""):
+        names = set()
+        for dir_path, _, file_names in os.walk(self.root):
+            for file_name in file_names:
+                if file_name.endswith(".tmp"):
+                    continue
+                name = os.path.relpath(os.path.join(dir_path, file_name), self.root).replace(os.sep, "/")
+                if name.startswith(prefix):
+                    names.add(name)
+        return names
+
+    def delete(self, path):
+        try:
+            os.remove(self._file_path(path))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def stat(self, path):
+        try:
+            st = os.stat(self._file_path(path))
+        except FileNotFoundError:
+            return None
+        return {"generation": st.st_mtime_ns, "etag": f"{st.st_mtime_ns}-{st.st_size}", "size": st.st_size}
+
+class MemoryStorage:
+    """物件只存在目前程序的記憶體中 (繪圖子程序各有一份)，程序結束即消失。"""
+    kind = "memory"
+
+    def __init__(self, name="memory"):
+        self.name = name
+        self._objects = {}  # path -> (bytes, generation)
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def uri(self, path):
+        return f"memory://{self.name}/{path}"
+
+    def public_url(self, path):
+        return self.uri(path)
+
+    def exists(self, path):
+        with self._lock:
+            return path in self._objects
+
+    def get(self, path, generation=None):
+        with self._lock:
+            entry = self._objects.get(path)
+        if entry is None or (generation is not None and entry[1] != generation):
+            return None
+        return entry[0]
+
+    def put(self, path, data, content_type='application/octet-stream', cache_control=None):
+        with self._lock:
+            self._generation += 1
+            self._objects[path] = (bytes(data), self._generation)
+
+    def list(self, prefix=""):
+        with self._lock:
+            return {path for path in self._objects if path.startswith(prefix)}
+
+    def delete(self, path):
+        with self._lock:
+            return self._objects.pop(path, None) is not None
+
+    def stat(self, path):
+        with self._lock:
+            entry = self._objects.get(path)
+        if entry is None:
+            return None
+        data, generation = entry
+        return {"generation": generation, "etag": str(generation), "size": len(data)}
+
+def create_backend(kind=None, bucket=None, data_dir=None):
+    """依 kind (預設為 STORAGE_BACKEND) 建立儲存後端；gcs 需傳入 bucket。"""
+    kind = (kind or STORAGE_BACKEND).lower()
+    if kind == "gcs":
+        if bucket is None:
+            raise ValueError("GCS 儲存後端需要 bucket。")
+        return GCSStorage(bucket)
+    if kind == "local":
+        root = STORAGE_LOCAL_DIR
+        if data_dir and not os.path.isabs(root):
+            root = os.path.join(data_dir, root)
+        return LocalStorage(root)
+    if kind == "memory":
+        return MemoryStorage()
+    raise ValueError(f"不支援的 STORAGE_BACKEND: {kind} (可用: gcs, local, memory)")